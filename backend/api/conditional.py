@@ -0,0 +1,61 @@
+import hashlib
+
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+from recipes.models import Favorite, ShoppingList, Subscription, User
+
+
+USER_STATE_MODELS = (Favorite, ShoppingList, Subscription)
+
+
+def get_user_state(user):
+    """Версия состояния пользователя: избранное, покупки, подписки.
+
+    Идентификаторы только растут, поэтому пара (количество, максимальный id)
+    меняется при любом добавлении или удалении записи.
+    """
+    if user.is_anonymous:
+        return None
+    annotations = {}
+    for model in USER_STATE_MODELS:
+        rows = model.objects.filter(
+            user=OuterRef('pk')).order_by().values('user')
+        name = model._meta.model_name
+        annotations[f'{name}_count'] = Subquery(
+            rows.annotate(count=Count('pk')).values('count'))
+        annotations[f'{name}_max'] = Subquery(
+            rows.annotate(max=Max('pk')).values('max'))
+    return User.objects.filter(pk=user.pk).annotate(
+        **annotations).values_list(*annotations).get()
+
+
+def get_last_modified(*dates):
+    """Самая поздняя из дат изменения; None пропускается."""
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def make_etag(*parts):
+    return '"{}"'.format(
+        hashlib.md5(repr(parts).encode()).hexdigest())
+
+
+def conditional_response(request, get_response, etag, last_modified=None):
+    """Ответ 304, если валидаторы клиента совпали, иначе get_response().
+
+    last_modified — datetime, передается только для ответов,
+    не зависящих от пользователя.
+    """
+    timestamp = (
+        int(last_modified.timestamp()) if last_modified is not None else None)
+    response = get_conditional_response(
+        request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = get_response()
+    response['ETag'] = etag
+    if timestamp is not None:
+        response['Last-Modified'] = http_date(timestamp)
+    patch_vary_headers(response, ('Authorization',))
+    return response
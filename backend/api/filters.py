@@ -1,6 +1,8 @@
 from django_filters.rest_framework import FilterSet, filters
+from rest_framework.filters import OrderingFilter
 
-from recipes.models import Ingredient, Recipe, Tag
+from .search import search_recipes
+from recipes.models import Recipe, Tag
 
 
 class RecipeFilter(FilterSet):
@@ -12,25 +14,38 @@ class RecipeFilter(FilterSet):
         to_field_name='slug',
         queryset=Tag.objects.all()
     )
+    search = filters.CharFilter(method='get_search')
 
     def get_is_favorited(self, recipes, name, value):
         if value and self.request.user.is_authenticated:
-            return recipes.filter(favorites__user=self.request.user)
+            return recipes.filter(is_favorited=True)
         return recipes
 
     def get_is_in_shopping_cart(self, recipes, name, value):
         if value and self.request.user.is_authenticated:
-            return recipes.filter(shoppinglists__user=self.request.user)
+            return recipes.filter(is_in_shopping_cart=True)
         return recipes
 
+    def get_search(self, recipes, name, value):
+        return search_recipes(recipes, value)
+
     class Meta:
         model = Recipe
         fields = ('author', 'tags')
 
 
-class IngredientFilter(FilterSet):
-    name = filters.CharFilter(lookup_expr='startswith')
-
-    class Meta:
-        model = Ingredient
-        fields = ['name']
+class RecipeOrderingFilter(OrderingFilter):
+    """?ordering=-favorites_count и т.п.; id в конце делает порядок
+    однозначным для постраничной и курсорной разбивки. При ?search= без
+    явной сортировки рецепты упорядочены по релевантности."""
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if (
+            request.query_params.get('search', '').strip()
+            and not request.query_params.get(self.ordering_param)
+        ):
+            ordering = ('-search_rank', *ordering)
+        if ordering and 'id' not in ordering and '-id' not in ordering:
+            return (*ordering, 'id')
+        return ordering
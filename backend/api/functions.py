@@ -1,32 +1,96 @@
+import csv
+import hashlib
+
+from django.conf import settings
 from django.utils import timezone
 
-from recipes.models import ShoppingList
+from .pdf import stream_pdf
+from recipes.models import ShoppingList, ShoppingListIngredient
 
 
-def get_shopping_list_text(user):
-    return '\n'.join([
-        'Список покупок',
-        f'Дата: {timezone.now().strftime("%d-%m-%Y")}',
-        'Пользователь: {user_full_name}'.format(
-            user_full_name=user.get_full_name()
-        ),
-        *[
+SHOPPING_LIST_CHUNK_SIZE = 500
+
+
+class Echo:
+    """Буфер для csv.writer, возвращающий записанную строку."""
+
+    def write(self, value):
+        return value
+
+
+def get_shopping_list_ingredients(user):
+    return ShoppingList.get_shopping_list_ingredients(user).iterator(
+        chunk_size=SHOPPING_LIST_CHUNK_SIZE)
+
+
+def get_shopping_list_recipes(user):
+    return ShoppingList.get_shopping_list_recipes(user).values_list(
+        'name',
+        flat=True
+    ).iterator(chunk_size=SHOPPING_LIST_CHUNK_SIZE)
+
+
+def get_shopping_list_lines(user):
+    yield 'Список покупок'
+    yield f'Дата: {timezone.now().strftime("%d-%m-%Y")}'
+    yield 'Пользователь: {user_full_name}'.format(
+        user_full_name=user.get_full_name()
+    )
+    for index, ingredient in enumerate(
+        get_shopping_list_ingredients(user), start=1
+    ):
+        yield (
             f'{index}. {ingredient["amount"]} '
             f'({ingredient["ingredient__measurement_unit"]}) '
             f'- {ingredient["ingredient__name"]:.50} '
-            for index, ingredient in enumerate(
-                ShoppingList.get_shopping_list_ingredients(user),
-                start=1
-            )
-        ],
-        'Список рецептов: ',
-        *[
-            f'{index}. {recipe:.50}'
-            for index, recipe in enumerate(
-                ShoppingList.get_shopping_list_recipes(user).values_list(
-                    'recipe__name',
-                    flat=True
-                ),
-                start=1
-            )]
-    ])
+        )
+    yield 'Список рецептов: '
+    for index, recipe in enumerate(get_shopping_list_recipes(user), start=1):
+        yield f'{index}. {recipe:.50}'
+
+
+def get_shopping_list_text(user):
+    for line in get_shopping_list_lines(user):
+        yield f'{line}\n'
+
+
+def get_shopping_list_csv(user):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('Продукт', 'Единица измерения', 'Количество'))
+    for ingredient in get_shopping_list_ingredients(user):
+        yield writer.writerow((
+            ingredient['ingredient__name'],
+            ingredient['ingredient__measurement_unit'],
+            ingredient['amount'],
+        ))
+
+
+def get_shopping_list_pdf(user):
+    return stream_pdf(
+        get_shopping_list_lines(user), settings.SHOPPING_LIST_PDF_FONT)
+
+
+SHOPPING_LIST_EXPORTERS = {
+    'txt': get_shopping_list_text,
+    'csv': get_shopping_list_csv,
+    'pdf': get_shopping_list_pdf,
+}
+
+
+def get_shopping_list_etag(user, format):
+    """ETag списка покупок: меняется вместе с его содержимым."""
+    etag = hashlib.md5(
+        f'{format}:{timezone.now().date()}:{user.get_full_name()}'.encode())
+    for row in ShoppingListIngredient.objects.filter(
+        user=user
+    ).order_by('ingredient').values_list(
+        'ingredient', 'total_amount'
+    ).iterator(chunk_size=SHOPPING_LIST_CHUNK_SIZE):
+        etag.update(f'{row}'.encode())
+    for recipe in ShoppingList.objects.filter(
+        user=user
+    ).order_by('recipe').values_list(
+        'recipe', 'recipe__name'
+    ).iterator(chunk_size=SHOPPING_LIST_CHUNK_SIZE):
+        etag.update(f'{recipe}'.encode())
+    return f'"{etag.hexdigest()}"'
@@ -0,0 +1,225 @@
+import base64
+import json
+import tempfile
+from io import BytesIO
+from time import perf_counter
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+
+from .generate_data import PASSWORD
+from recipes.models import Ingredient, Recipe, Tag, User
+
+NO_DATA_MESSAGE = 'Нет данных для замеров: выполните generate_data'
+
+
+def get_image_data_url():
+    buffer = BytesIO()
+    Image.new('RGB', (64, 64), (200, 120, 60)).save(buffer, 'PNG')
+    encoded = base64.b64encode(buffer.getvalue()).decode()
+    return f'data:image/png;base64,{encoded}'
+
+
+class Rollback(Exception):
+    """Откатывает транзакцию после замера изменяющего запроса."""
+
+
+def get_endpoints(recipe, other_recipe, tag, ingredient, author):
+    """Эндпоинты api/urls.py: (имя, метод, url, тело, изменяет ли данные).
+
+    recipe принадлежит пользователю, от имени которого идут запросы
+    (его пароль — PASSWORD из generate_data), other_recipe нет в его
+    избранном и списке покупок, а на author он не подписан.
+    """
+    user = recipe.author
+    recipes = f'/api/recipes/{recipe.id}'
+    other_recipes = f'/api/recipes/{other_recipe.id}'
+    recipe_data = {
+        'name': recipe.name,
+        'text': recipe.text,
+        'cooking_time': recipe.cooking_time,
+        'tags': list(recipe.tags.values_list('id', flat=True)),
+        'ingredients': [
+            {'id': ingredient_id, 'amount': amount}
+            for ingredient_id, amount
+            in recipe.recipeingredients.values_list(
+                'ingredient_id', 'amount')
+        ],
+    }
+    return (
+        ('tags', 'get', '/api/tags/', None, False),
+        ('tag', 'get', f'/api/tags/{tag.id}/', None, False),
+        ('ingredients', 'get', '/api/ingredients/', None, False),
+        ('ingredients_search', 'get',
+         f'/api/ingredients/?name={ingredient.name[:2]}', None, False),
+        ('ingredient', 'get', f'/api/ingredients/{ingredient.id}/',
+         None, False),
+        ('recipes', 'get', '/api/recipes/', None, False),
+        ('recipes_cursor', 'get', '/api/recipes/?pagination=cursor',
+         None, False),
+        ('recipes_estimate', 'get', '/api/recipes/?count=estimate',
+         None, False),
+        ('recipes_tags', 'get', f'/api/recipes/?tags={tag.slug}',
+         None, False),
+        ('recipes_popular', 'get', '/api/recipes/?ordering=-favorites_count',
+         None, False),
+        ('recipes_search', 'get',
+         f'/api/recipes/?search={recipe.name.split()[0]}', None, False),
+        ('recipes_favorited', 'get', '/api/recipes/?is_favorited=1',
+         None, False),
+        ('recipe', 'get', f'{recipes}/', None, False),
+        ('recipe_similar', 'get', f'{recipes}/similar/', None, False),
+        ('feed', 'get', '/api/recipes/feed/', None, False),
+        ('trending', 'get', '/api/recipes/trending/', None, False),
+        ('by_ingredients', 'get',
+         f'/api/recipes/by_ingredients/?ingredients={ingredient.id}',
+         None, False),
+        ('shopping_cart_summary', 'get', '/api/recipes/shopping_cart/summary/',
+         None, False),
+        ('download_shopping_cart', 'get',
+         '/api/recipes/download_shopping_cart/', None, False),
+        ('users', 'get', '/api/users/', None, False),
+        ('user', 'get', f'/api/users/{author.id}/', None, False),
+        ('me', 'get', '/api/users/me/', None, False),
+        ('subscriptions', 'get', '/api/users/subscriptions/', None, False),
+        ('favorite_add', 'post', f'{other_recipes}/favorite/', None, True),
+        ('shopping_cart_add', 'post', f'{other_recipes}/shopping_cart/',
+         None, True),
+        ('shopping_cart_bulk_add', 'post', '/api/recipes/shopping_cart/',
+         {'recipes': [other_recipe.id]}, True),
+        ('subscribe', 'post', f'/api/users/{author.id}/subscribe/',
+         None, True),
+        ('recipe_create', 'post', '/api/recipes/',
+         {**recipe_data, 'image': get_image_data_url()}, True),
+        ('recipe_update', 'patch', f'{recipes}/', recipe_data, True),
+        ('recipe_delete', 'delete', f'{recipes}/', None, True),
+        ('user_create', 'post', '/api/users/', {
+            'email': 'new-user@example.com',
+            'username': 'new_user',
+            'first_name': 'Новый',
+            'last_name': 'Пользователь',
+            'password': PASSWORD,
+        }, True),
+        ('token_login', 'post', '/api/auth/token/login/',
+         {'email': user.email, 'password': PASSWORD}, True),
+        ('token_logout', 'post', '/api/auth/token/logout/', None, True),
+    )
+
+
+class Command(BaseCommand):
+    help = ('Замер задержек (p50/p99) и числа запросов к базе для '
+            'эндпоинтов API. Результат — JSON для сравнения между коммитами')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument(
+            '--output', help='Файл для результатов (по умолчанию stdout)')
+        parser.add_argument(
+            '--only', nargs='*', default=None,
+            help='Замерить только эндпоинты с этими именами',
+        )
+        parser.add_argument(
+            '--writes',
+            action='store_true',
+            help='Замерить и изменяющие запросы (каждый откатывается)',
+        )
+
+    def handle(self, *args, **options):
+        client, endpoints = self.prepare()
+        results = []
+        # Откат транзакции не удаляет файлы, сохраненные при создании
+        # рецепта: изображения пишутся во временный каталог.
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            QUERY_BUDGET_STRICT=False,
+            MEDIA_ROOT=media_root,
+        ):
+            for name, method, url, data, write in endpoints:
+                if options['only'] is not None and name not in options['only']:
+                    continue
+                if write and not options['writes']:
+                    continue
+                results.append(self.measure(
+                    client, name, method, url, data, write,
+                    options['iterations'], options['warmup']
+                ))
+        report = json.dumps({
+            'created_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'iterations': options['iterations'],
+            'recipes': Recipe.objects.count(),
+            'users': User.objects.count(),
+            'endpoints': results,
+        }, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(report)
+        else:
+            self.stdout.write(report)
+
+    def prepare(self):
+        recipe = Recipe.objects.filter(
+            author__subscriptions_as_user__isnull=False
+        ).select_related('author').order_by(
+            '-favorites_count', 'pk').first()
+        tag = Tag.objects.first()
+        ingredient = Ingredient.objects.order_by('pk').first()
+        if None in (recipe, tag, ingredient):
+            raise CommandError(NO_DATA_MESSAGE)
+        user = recipe.author
+        other_recipe = Recipe.objects.exclude(
+            favorites__user=user).exclude(
+            shoppinglists__user=user).order_by('pk').first()
+        author = User.objects.exclude(pk=user.pk).exclude(
+            subscriptions__user=user).order_by('pk').first()
+        if None in (other_recipe, author):
+            raise CommandError(NO_DATA_MESSAGE)
+        client = APIClient()
+        client.force_authenticate(user)
+        return client, get_endpoints(
+            recipe, other_recipe, tag, ingredient, author)
+
+    def request(self, client, method, url, data):
+        start = perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(client, method)(url, data, format='json')
+            if response.streaming:
+                b''.join(response.streaming_content)
+        return perf_counter() - start, len(queries), response.status_code
+
+    def measure(self, client, name, method, url, data, write,
+                iterations, warmup):
+        durations, query_counts, statuses = [], [], set()
+        for iteration in range(warmup + iterations):
+            if write:
+                try:
+                    with transaction.atomic():
+                        duration, query_count, status = self.request(
+                            client, method, url, data)
+                        raise Rollback
+                except Rollback:
+                    pass
+            else:
+                duration, query_count, status = self.request(
+                    client, method, url, data)
+            if iteration >= warmup:
+                durations.append(duration * 1000)
+                query_counts.append(query_count)
+                statuses.add(status)
+        return {
+            'name': name,
+            'method': method.upper(),
+            'url': url,
+            'status': sorted(statuses),
+            'p50_ms': round(float(np.percentile(durations, 50)), 2),
+            'p99_ms': round(float(np.percentile(durations, 99)), 2),
+            'mean_ms': round(float(np.mean(durations)), 2),
+            'queries': max(query_counts),
+        }
@@ -0,0 +1,253 @@
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+from io import BytesIO
+from uuid import uuid4
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection
+from django.db.models import Max
+from django.utils import timezone
+from PIL import Image
+
+from api.search import rebuild_recipe_index
+from recipes.models import (
+    Favorite,
+    Ingredient,
+    Recipe,
+    RecipeIngredient,
+    ReferenceVersion,
+    ShoppingList,
+    Subscription,
+    Tag,
+    User,
+)
+
+WORDS = (
+    'борщ', 'суп', 'салат', 'пирог', 'котлеты', 'каша', 'блины', 'плов',
+    'рагу', 'запеканка', 'гуляш', 'омлет', 'паста', 'соус', 'курица',
+    'говядина', 'рыба', 'грибы', 'овощи', 'сыр', 'томатный', 'сливочный',
+    'острый', 'домашний', 'быстрый', 'летний', 'праздничный', 'постный',
+)
+PASSWORD = 'benchmark-password'
+DAYS = 365
+NO_INGREDIENTS_MESSAGE = (
+    'Нет продуктов или тегов: выполните import_ingredients и import_tags')
+
+
+@contextmanager
+def manual_pub_date():
+    """Позволяет задать pub_date при bulk_create вместо auto_now_add."""
+    field = Recipe._meta.get_field('pub_date')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+def get_next_id(model):
+    return (model.objects.aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+
+
+def reset_sequences(*models):
+    """После записи явных id сдвигает последовательности PostgreSQL."""
+    statements = connection.ops.sequence_reset_sql(no_style(), models)
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def get_placeholder_image():
+    buffer = BytesIO()
+    Image.new('RGB', (64, 64), (200, 120, 60)).save(buffer, 'PNG')
+    field = Recipe._meta.get_field('image')
+    return field.storage.save(
+        f'{field.upload_to}benchmark.png', ContentFile(buffer.getvalue()))
+
+
+def get_random_date(now):
+    return now - timedelta(seconds=random.randrange(DAYS * 24 * 3600))
+
+
+def get_pairs(count, left_ids, right_ids, exclude_same=False):
+    pairs = set()
+    while len(pairs) < count:
+        pair = (random.choice(left_ids), random.choice(right_ids))
+        if not (exclude_same and pair[0] == pair[1]):
+            pairs.add(pair)
+    return pairs
+
+
+class Command(BaseCommand):
+    help = ('Генерация синтетических данных для нагрузочных тестов: '
+            'пользователи, рецепты, избранное, списки покупок, подписки')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--recipes', type=int, default=10000)
+        parser.add_argument(
+            '--ingredients-per-recipe', type=int, default=10,
+            help='Среднее число продуктов в рецепте',
+        )
+        parser.add_argument('--favorites', type=int, default=50000)
+        parser.add_argument('--carts', type=int, default=20000)
+        parser.add_argument('--subscriptions', type=int, default=20000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument(
+            '--similar',
+            action='store_true',
+            help='Также рассчитать похожие рецепты (долго)',
+        )
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        self.batch_size = options['batch_size']
+        self.now = timezone.now()
+        ingredient_ids = list(Ingredient.objects.values_list('id', flat=True))
+        tag_ids = list(Tag.objects.values_list('id', flat=True))
+        if not ingredient_ids or not tag_ids:
+            raise CommandError(NO_INGREDIENTS_MESSAGE)
+        user_ids = self.create_users(options['users'])
+        recipe_ids = self.create_recipes(
+            options['recipes'],
+            user_ids,
+            ingredient_ids,
+            tag_ids,
+            options['ingredients_per_recipe'],
+        )
+        for model, count in (
+            (Favorite, options['favorites']),
+            (ShoppingList, options['carts']),
+        ):
+            self.create_user_recipes(
+                model, min(count, len(user_ids) * len(recipe_ids)),
+                user_ids, recipe_ids)
+        self.create_subscriptions(
+            min(options['subscriptions'],
+                len(user_ids) * (len(user_ids) - 1)),
+            user_ids
+        )
+        self.stdout.write('Пересчет производных данных')
+        rebuild_recipe_index()
+        ReferenceVersion.bump(ReferenceVersion.RECIPE_INGREDIENTS)
+        call_command('rebuild_shopping_lists', stdout=self.stdout)
+        call_command('reconcile_recipe_counters', stdout=self.stdout)
+        call_command('rebuild_feeds', stdout=self.stdout)
+        call_command('refresh_trending', '--full', stdout=self.stdout)
+        if options['similar']:
+            call_command(
+                'build_similar_recipes', '--full', stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(
+            f'Создано пользователей: {len(user_ids)}, '
+            f'рецептов: {len(recipe_ids)}'))
+
+    def create_users(self, count):
+        prefix = uuid4().hex[:8]
+        password = make_password(PASSWORD)
+        start = get_next_id(User)
+        for offset in range(0, count, self.batch_size):
+            User.objects.bulk_create(
+                User(
+                    id=start + number,
+                    username=f'bench_{prefix}_{number}',
+                    email=f'bench_{prefix}_{number}@example.com',
+                    first_name=random.choice(WORDS).title(),
+                    last_name=random.choice(WORDS).title(),
+                    password=password,
+                )
+                for number in range(
+                    offset, min(offset + self.batch_size, count))
+            )
+        reset_sequences(User)
+        return list(range(start, start + count))
+
+    def create_recipes(self, count, user_ids, ingredient_ids, tag_ids,
+                       ingredients_per_recipe):
+        image = get_placeholder_image()
+        start = get_next_id(Recipe)
+        max_ingredients = min(
+            len(ingredient_ids), ingredients_per_recipe * 2 - 1)
+        for offset in range(0, count, self.batch_size):
+            recipe_ids = range(
+                start + offset,
+                start + min(offset + self.batch_size, count)
+            )
+            with manual_pub_date():
+                Recipe.objects.bulk_create(
+                    Recipe(
+                        id=recipe_id,
+                        author_id=random.choice(user_ids),
+                        name=' '.join(random.sample(WORDS, 3)).capitalize(),
+                        text=' '.join(random.choices(WORDS, k=30)),
+                        cooking_time=random.randint(5, 180),
+                        image=image,
+                        pub_date=get_random_date(self.now),
+                    )
+                    for recipe_id in recipe_ids
+                )
+            RecipeIngredient.objects.bulk_create(
+                (
+                    RecipeIngredient(
+                        recipe_id=recipe_id,
+                        ingredient_id=ingredient_id,
+                        amount=random.randint(1, 500),
+                    )
+                    for recipe_id in recipe_ids
+                    for ingredient_id in random.sample(
+                        ingredient_ids, random.randint(1, max_ingredients))
+                ),
+                batch_size=self.batch_size
+            )
+            Recipe.tags.through.objects.bulk_create(
+                (
+                    Recipe.tags.through(recipe_id=recipe_id, tag_id=tag_id)
+                    for recipe_id in recipe_ids
+                    for tag_id in random.sample(
+                        tag_ids, random.randint(1, min(3, len(tag_ids))))
+                ),
+                batch_size=self.batch_size
+            )
+            self.stdout.write(
+                f'Рецептов: {min(offset + self.batch_size, count)}/{count}')
+        reset_sequences(Recipe)
+        return list(range(start, start + count))
+
+    def create_user_recipes(self, model, count, user_ids, recipe_ids):
+        for offset in range(0, count, self.batch_size):
+            model.objects.bulk_create(
+                (
+                    model(
+                        user_id=user_id,
+                        recipe_id=recipe_id,
+                        added_at=self.now - timedelta(
+                            seconds=random.randrange(30 * 24 * 3600)),
+                    )
+                    for user_id, recipe_id in get_pairs(
+                        min(self.batch_size, count - offset),
+                        user_ids,
+                        recipe_ids
+                    )
+                ),
+                ignore_conflicts=True
+            )
+
+    def create_subscriptions(self, count, user_ids):
+        for offset in range(0, count, self.batch_size):
+            Subscription.objects.bulk_create(
+                (
+                    Subscription(user_id=user_id, author_id=author_id)
+                    for user_id, author_id in get_pairs(
+                        min(self.batch_size, count - offset),
+                        user_ids,
+                        user_ids,
+                        exclude_same=True
+                    )
+                ),
+                ignore_conflicts=True
+            )
@@ -0,0 +1,119 @@
+import json
+import logging
+import re
+from collections import Counter
+from contextlib import ExitStack
+from time import perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+IN_LIST_PATTERN = re.compile(r'IN \(%s(?:, %s)*\)')
+BUDGET_EXCEEDED_MESSAGE = (
+    '{view}: {count} запросов к базе при бюджете {budget}')
+N_PLUS_ONE_MESSAGE = '{view}: повторяющийся запрос ({count} раз): {sql}'
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    """Запрос к API превысил бюджет запросов к базе или содержит N+1."""
+
+
+class QueryStats:
+    """Обертка выполнения SQL: считает запросы, время и формы запросов."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += perf_counter() - start
+            self.count += 1
+            # Списки IN разной длины — одна и та же форма запроса.
+            self.shapes[IN_LIST_PATTERN.sub('IN (...)', sql)] += 1
+
+    def get_repeated(self):
+        return [
+            (sql, count) for sql, count in self.shapes.most_common()
+            if count >= settings.QUERY_N_PLUS_ONE_THRESHOLD
+        ]
+
+
+def get_budget(view_name, method):
+    budgets = settings.QUERY_BUDGETS
+    return budgets.get(
+        f'{view_name}:{method}',
+        budgets.get(view_name, settings.QUERY_BUDGET_DEFAULT)
+    )
+
+
+class QueryBudgetMiddleware:
+    """Считает запросы к базе для каждого запроса к API.
+
+    Сравнивает их число с бюджетом представления (QUERY_BUDGETS),
+    ищет повторяющиеся формы SQL (N+1) и пишет итог в журнал, а при DEBUG
+    еще и в заголовок Server-Timing. По умолчанию включен только при
+    DEBUG. В строгом режиме (QUERY_BUDGET_STRICT, для тестов) превышение
+    бюджета или N+1 приводит к исключению.
+    Запросы, которые выполняются при отдаче потокового ответа,
+    не учитываются.
+    """
+
+    def __init__(self, get_response):
+        if not settings.QUERY_BUDGET_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not request.path.startswith(settings.QUERY_BUDGET_PATH_PREFIX):
+            return self.get_response(request)
+        stats = QueryStats()
+        start = perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+        duration = perf_counter() - start
+        match = request.resolver_match
+        view = match.view_name if match else request.path
+        budget = get_budget(view, request.method)
+        repeated = stats.get_repeated()
+        if settings.DEBUG:
+            response['Server-Timing'] = (
+                f'db;dur={stats.duration * 1000:.1f};'
+                f'desc="{stats.count} queries"'
+                f', app;dur={duration * 1000:.1f}'
+            )
+        problems = [
+            N_PLUS_ONE_MESSAGE.format(view=view, count=count, sql=sql)
+            for sql, count in repeated
+        ]
+        if stats.count > budget:
+            problems.insert(0, BUDGET_EXCEEDED_MESSAGE.format(
+                view=view, count=stats.count, budget=budget))
+        logger.log(
+            logging.WARNING if problems else logging.INFO,
+            json.dumps({
+                'view': view,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'queries': stats.count,
+                'budget': budget,
+                'db_ms': round(stats.duration * 1000, 1),
+                'total_ms': round(duration * 1000, 1),
+                'repeated': [
+                    {'sql': sql, 'count': count} for sql, count in repeated
+                ],
+            }, ensure_ascii=False)
+        )
+        if problems and settings.QUERY_BUDGET_STRICT:
+            raise QueryBudgetExceeded('\n'.join(problems))
+        return response
@@ -0,0 +1,103 @@
+import zlib
+from itertools import islice
+
+from PIL import Image, ImageDraw, ImageFont
+
+
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+DPI_SCALE = 2
+FONT_SIZE = 12
+LINE_HEIGHT = 18
+MARGIN = 40
+LINES_PER_PAGE = (PAGE_HEIGHT - 2 * MARGIN) // LINE_HEIGHT
+
+
+def get_font(font_path):
+    try:
+        return ImageFont.truetype(font_path, FONT_SIZE * DPI_SCALE)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def render_page(lines, font):
+    """Растеризует строки страницы в сжатое изображение в оттенках серого."""
+    image = Image.new(
+        'L', (PAGE_WIDTH * DPI_SCALE, PAGE_HEIGHT * DPI_SCALE), 255)
+    draw = ImageDraw.Draw(image)
+    for index, line in enumerate(lines):
+        draw.text(
+            (MARGIN * DPI_SCALE,
+             (MARGIN + index * LINE_HEIGHT) * DPI_SCALE),
+            line,
+            font=font,
+            fill=0
+        )
+    return image.size, zlib.compress(image.tobytes())
+
+
+def stream_pdf(lines, font_path):
+    """Генератор PDF: страницы отдаются по мере готовности.
+
+    Каждая страница — растровое изображение текста, поэтому кириллица
+    отображается без встраивания шрифтов в документ.
+    """
+    font = get_font(font_path)
+    offsets = {}
+    position = 0
+
+    def write(chunk):
+        nonlocal position
+        position += len(chunk)
+        return chunk
+
+    def write_object(number, body, stream=None):
+        offsets[number] = position
+        chunk = f'{number} 0 obj\n'.encode() + body
+        if stream is not None:
+            chunk += b'\nstream\n' + stream + b'\nendstream'
+        return write(chunk + b'\nendobj\n')
+
+    yield write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    lines = iter(lines)
+    page_numbers = []
+    number = 3
+    while True:
+        page_lines = list(islice(lines, LINES_PER_PAGE))
+        if not page_lines and page_numbers:
+            break
+        (width, height), data = render_page(page_lines, font)
+        yield write_object(number, (
+            f'<< /Type /XObject /Subtype /Image /Width {width} '
+            f'/Height {height} /ColorSpace /DeviceGray '
+            f'/BitsPerComponent 8 /Filter /FlateDecode '
+            f'/Length {len(data)} >>'
+        ).encode(), data)
+        content = (
+            f'q {PAGE_WIDTH} 0 0 {PAGE_HEIGHT} 0 0 cm /Im0 Do Q'
+        ).encode()
+        yield write_object(
+            number + 1, f'<< /Length {len(content)} >>'.encode(), content)
+        yield write_object(number + 2, (
+            f'<< /Type /Page /Parent 2 0 R '
+            f'/MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] '
+            f'/Resources << /XObject << /Im0 {number} 0 R >> >> '
+            f'/Contents {number + 1} 0 R >>'
+        ).encode())
+        page_numbers.append(number + 2)
+        number += 3
+    kids = ' '.join(f'{page} 0 R' for page in page_numbers)
+    yield write_object(2, (
+        f'<< /Type /Pages /Kids [{kids}] /Count {len(page_numbers)} >>'
+    ).encode())
+    yield write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+    xref_position = position
+    yield write(
+        f'xref\n0 {number}\n0000000000 65535 f \n'.encode()
+        + b''.join(
+            f'{offsets[index]:010d} 00000 n \n'.encode()
+            for index in range(1, number)
+        )
+        + f'trailer\n<< /Size {number} /Root 1 0 R >>\n'
+          f'startxref\n{xref_position}\n%%EOF\n'.encode()
+    )
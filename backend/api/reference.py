@@ -0,0 +1,83 @@
+from collections import namedtuple
+from time import monotonic
+
+from django.conf import settings
+
+from recipes.models import Ingredient, ReferenceVersion, Tag
+
+
+class ReferenceCache:
+    """Кэш справочника в памяти процесса.
+
+    Записи хранятся кортежами по id. Раз в REFERENCE_CACHE_TIMEOUT секунд
+    кэш сверяет свою версию с ReferenceVersion и перечитывает справочник,
+    если версию увеличил другой процесс. Промах по id досрочно сверяет
+    версию не чаще того же интервала: несуществующие id не заставляют
+    перечитывать справочник.
+    """
+
+    def __init__(self, name, model, fields):
+        self.name = name
+        self.model = model
+        self.fields = fields
+        self.item_class = namedtuple(f'{model.__name__}Data', fields)
+        self.items = {}
+        self.version = None
+        self.checked_at = None
+        self.missed_at = None
+
+    def load(self):
+        return {
+            row[0]: self.item_class(*row)
+            for row in self.model.objects.values_list(*self.fields)
+        }
+
+    def invalidate(self):
+        self.version = None
+        self.checked_at = None
+
+    def refresh(self, force=False, check=False):
+        """Сверяет версию, если истек интервал или check, и перечитывает
+        справочник, если версия изменилась или force."""
+        now = monotonic()
+        if (
+            not force
+            and not check
+            and self.checked_at is not None
+            and now - self.checked_at < settings.REFERENCE_CACHE_TIMEOUT
+        ):
+            return
+        version = ReferenceVersion.get_version(self.name)
+        if force or version != self.version:
+            self.reload(version, force)
+        self.checked_at = now
+
+    def reload(self, version, force):
+        self.items = self.load()
+        self.version = version
+
+    def all(self):
+        self.refresh()
+        return list(self.items.values())
+
+    def get(self, pk):
+        self.refresh()
+        if pk not in self.items:
+            now = monotonic()
+            if (
+                self.missed_at is None
+                or now - self.missed_at >= settings.REFERENCE_CACHE_TIMEOUT
+            ):
+                self.missed_at = now
+                self.refresh(check=True)
+        return self.items.get(pk)
+
+    def get_many(self, pks):
+        return [item for item in map(self.get, pks) if item is not None]
+
+
+TAGS = ReferenceCache(
+    ReferenceVersion.TAGS, Tag, ('id', 'name', 'color', 'slug'))
+INGREDIENTS = ReferenceCache(
+    ReferenceVersion.INGREDIENTS, Ingredient,
+    ('id', 'name', 'measurement_unit'))
@@ -0,0 +1,378 @@
+import logging
+from bisect import bisect_left
+from collections import namedtuple
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from threading import Lock, local
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import (
+    Case,
+    F,
+    FloatField,
+    Func,
+    IntegerField,
+    Lookup,
+    Q,
+    TextField,
+    Value,
+    When,
+)
+from django.db.models.expressions import Col, Expression
+
+from .reference import INGREDIENTS, ReferenceCache
+from recipes.models import (
+    Ingredient,
+    Recipe,
+    RecipeIngredient,
+    ReferenceVersion,
+)
+
+RECIPE_SEARCH_CONFIG = 'russian'
+RECIPE_FTS_TABLE = 'recipes_recipe_fts'
+RECIPE_INGREDIENT_INDEX_CHUNK_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+InvertedIndex = namedtuple(
+    'InvertedIndex',
+    ('ingredient_ids', 'offsets', 'recipe_ids', 'recipes', 'recipe_sizes')
+)
+
+
+class IngredientPrefixIndex:
+    """Префиксный индекс названий продуктов в памяти процесса.
+
+    Названия хранятся отсортированными по casefold(), поэтому продукты
+    с общим префиксом занимают непрерывный диапазон, который находится
+    двоичным поиском. Используется там, где нет индексов PostgreSQL.
+    """
+
+    def __init__(self, ingredients):
+        self.source = ingredients
+        self.items = sorted(
+            (ingredient.name.casefold(), ingredient.name, ingredient.id)
+            for ingredient in ingredients.values()
+        )
+        self.keys = [key for key, _, _ in self.items]
+
+    def search(self, name, limit):
+        name = name.casefold()
+        found = []
+        for key, _, pk in self.items[bisect_left(self.keys, name):]:
+            if not key.startswith(name) or len(found) >= limit:
+                break
+            found.append(pk)
+        if len(found) < limit:
+            prefix_matches = set(found)
+            found.extend(
+                pk for key, _, pk in self.items
+                if name in key and pk not in prefix_matches
+            )
+        return found[:limit]
+
+
+_ingredient_index = None
+
+
+def get_ingredient_index():
+    """Индекс строится заново, когда кэш продуктов перечитан."""
+    global _ingredient_index
+    INGREDIENTS.refresh()
+    if (
+        _ingredient_index is None
+        or _ingredient_index.source is not INGREDIENTS.items
+    ):
+        _ingredient_index = IngredientPrefixIndex(INGREDIENTS.items)
+    return _ingredient_index
+
+
+_index_executor = None
+
+
+def get_index_executor():
+    global _index_executor
+    if _index_executor is None:
+        _index_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='recipe-ingredient-index')
+    return _index_executor
+
+
+def get_search_limit(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return settings.INGREDIENT_SEARCH_LIMIT
+    return max(1, min(limit, settings.INGREDIENT_SEARCH_LIMIT))
+
+
+class RecipeCoverage(Sequence):
+    """Найденные рецепты в отсортированных массивах NumPy.
+
+    Элементы — кортежи (recipe_id, coverage, matched); в объекты Python
+    превращается только запрошенный срез, то есть страница выдачи.
+    """
+
+    def __init__(self, recipes, coverage, matched):
+        self.recipes = recipes
+        self.coverage = coverage
+        self.matched = matched
+
+    def __len__(self):
+        return len(self.recipes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(zip(
+                self.recipes[index].tolist(),
+                self.coverage[index].tolist(),
+                self.matched[index].tolist(),
+            ))
+        return (
+            self.recipes[index].item(),
+            self.coverage[index].item(),
+            self.matched[index].item(),
+        )
+
+
+class RecipeIngredientIndex(ReferenceCache):
+    """Обратный индекс «продукт -> рецепты» в памяти процесса.
+
+    Пары (продукт, рецепт) хранятся отсортированными массивами NumPy:
+    рецепты продукта ingredient_ids[i] занимают отрезок recipe_ids
+    [offsets[i], offsets[i + 1]). Для каждого рецепта из recipes известно
+    число его продуктов recipe_sizes. Индекс перечитывается, когда
+    добавление или удаление продуктов рецептов увеличивает версию
+    RECIPE_INGREDIENTS; изменение названия, описания или количества
+    продукта индекс не сбрасывает.
+
+    Перечитывается индекс в фоновом потоке, а запросы до его окончания
+    получают прежний индекс. Синхронно индекс читается только в первый
+    раз и при force.
+    """
+
+    def __init__(self):
+        super().__init__(
+            ReferenceVersion.RECIPE_INGREDIENTS,
+            RecipeIngredient,
+            ('ingredient_id', 'recipe_id')
+        )
+        self.rebuild_lock = Lock()
+        self.rebuild = None
+
+    def load(self):
+        pairs = np.fromiter(
+            chain.from_iterable(
+                self.model.objects.order_by(
+                    *self.fields
+                ).values_list(*self.fields).iterator(
+                    chunk_size=RECIPE_INGREDIENT_INDEX_CHUNK_SIZE)
+            ),
+            dtype=np.int64
+        ).reshape(-1, 2)
+        ingredient_ids, starts = np.unique(pairs[:, 0], return_index=True)
+        recipes, recipe_sizes = np.unique(pairs[:, 1], return_counts=True)
+        return InvertedIndex(
+            ingredient_ids,
+            np.append(starts, len(pairs)),
+            pairs[:, 1].copy(),
+            recipes,
+            recipe_sizes,
+        )
+
+    def reload(self, version, force):
+        if force or not self.items:
+            super().reload(version, force)
+            return
+        with self.rebuild_lock:
+            if self.rebuild is None or self.rebuild.done():
+                self.rebuild = get_index_executor().submit(
+                    self.run_reload, version)
+
+    def run_reload(self, version):
+        try:
+            items = self.load()
+            self.items, self.version = items, version
+        except Exception:
+            logger.exception('Не удалось перечитать индекс продуктов рецептов')
+        finally:
+            connections.close_all()
+
+    def search(self, ingredient_ids):
+        """Рецепты, в которых есть хотя бы один из продуктов, по убыванию
+        доли имеющихся продуктов: RecipeCoverage."""
+        self.refresh()
+        index = self.items
+        wanted = np.unique(np.asarray(ingredient_ids, dtype=np.int64))
+        positions = np.searchsorted(index.ingredient_ids, wanted)
+        found = positions < len(index.ingredient_ids)
+        found[found] = index.ingredient_ids[positions[found]] == wanted[found]
+        positions = positions[found]
+        if not len(positions):
+            return RecipeCoverage(
+                np.empty(0, np.int64), np.empty(0), np.empty(0, np.int64))
+        recipes, matched = np.unique(
+            np.concatenate([
+                index.recipe_ids[index.offsets[i]:index.offsets[i + 1]]
+                for i in positions
+            ]),
+            return_counts=True
+        )
+        coverage = matched / index.recipe_sizes[
+            np.searchsorted(index.recipes, recipes)]
+        order = np.lexsort((recipes, -matched, -coverage))
+        return RecipeCoverage(
+            recipes[order], coverage[order], matched[order])
+
+
+RECIPE_INGREDIENT_INDEX = RecipeIngredientIndex()
+pending_index_invalidation = local()
+
+
+def invalidate_recipe_ingredient_index():
+    if getattr(pending_index_invalidation, 'scheduled', False):
+        pending_index_invalidation.scheduled = False
+        ReferenceVersion.bump(ReferenceVersion.RECIPE_INGREDIENTS)
+        RECIPE_INGREDIENT_INDEX.invalidate()
+
+
+def schedule_recipe_ingredient_index_invalidation(using=None):
+    """Сбрасывает индекс один раз после фиксации транзакции, в которой
+    у рецептов добавлялись или удалялись продукты: сами продукты
+    записываются после рецепта."""
+    pending_index_invalidation.scheduled = True
+    transaction.on_commit(invalidate_recipe_ingredient_index, using=using)
+
+
+def search_ingredients(name, limit):
+    """Продукты, в названии которых есть name: сначала
+    начинающиеся с name, затем остальные совпадения."""
+    if connection.vendor == 'postgresql':
+        ids = Ingredient.objects.filter(name__icontains=name).annotate(
+            rank=Case(
+                When(name__istartswith=name, then=0),
+                default=1,
+                output_field=IntegerField(),
+            )
+        ).order_by('rank', 'name').values_list('pk', flat=True)[:limit]
+    else:
+        ids = get_ingredient_index().search(name, limit)
+    return INGREDIENTS.get_many(ids)
+
+
+def get_fts_query(query):
+    """Запрос FTS5: каждое слово ищется как префикс. Стемминга для
+    русского языка в SQLite нет, префикс частично его заменяет."""
+    return ' '.join(
+        '"{}"*'.format(word.replace('"', '""')) for word in query.split()
+    )
+
+
+@TextField.register_lookup
+class FtsMatch(Lookup):
+    """Полнотекстовый запрос FTS5 к скрытому столбцу таблицы индекса."""
+
+    lookup_name = 'fts_match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', (*lhs_params, *rhs_params)
+
+
+class RecipeSearchVector(Expression):
+    """Хранимый tsvector рецепта. Колонку search_vector генерирует
+    PostgreSQL (миграция 0022), поэтому в модели она не объявлена:
+    Django пытался бы записывать ее при сохранении рецепта."""
+
+    def __init__(self, field):
+        super().__init__(output_field=field)
+
+    def resolve_expression(self, query=None, *args, **kwargs):
+        return Col(
+            query.get_initial_alias(), self.output_field, self.output_field)
+
+
+def search_recipes_postgresql(recipes, query):
+    # django.contrib.postgres требует psycopg2, которого может не быть
+    # там, где используется только SQLite.
+    from django.contrib.postgres.search import (
+        SearchQuery,
+        SearchRank,
+        SearchVectorField,
+    )
+
+    field = SearchVectorField()
+    field.set_attributes_from_name('search_vector')
+    search_query = SearchQuery(
+        query, config=RECIPE_SEARCH_CONFIG, search_type='websearch')
+    return recipes.alias(
+        search_vector=RecipeSearchVector(field)
+    ).filter(search_vector=search_query).annotate(search_rank=SearchRank(
+        F('search_vector'), search_query, cover_density=True))
+
+
+def search_recipes(recipes, query):
+    """Полнотекстовый поиск по названию и описанию рецептов.
+
+    Добавляет к рецептам оценку релевантности search_rank: в PostgreSQL —
+    по хранимому tsvector с GIN индексом, в SQLite — по таблице FTS5.
+    """
+    vendor = connections[recipes.db].vendor
+    if vendor == 'postgresql':
+        return search_recipes_postgresql(recipes, query)
+    if vendor == 'sqlite':
+        match = get_fts_query(query)
+        if not match:
+            return recipes.none()
+        # Индекс присоединяется к рецептам: MATCH выполняется один раз,
+        # и bm25 считается для тех же строк (название важнее описания).
+        return recipes.filter(
+            search_entry__document__fts_match=match
+        ).annotate(search_rank=Func(
+            F('search_entry__document'),
+            template='-bm25(%(expressions)s, 2.0, 1.0)',
+            output_field=FloatField()
+        ))
+    return recipes.filter(
+        Q(name__icontains=query) | Q(text__icontains=query)
+    ).annotate(search_rank=Value(0.0, output_field=FloatField()))
+
+
+def index_recipe(recipe):
+    """Обновляет запись рецепта в FTS5. В PostgreSQL tsvector
+    пересчитывается самой СУБД."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {RECIPE_FTS_TABLE} WHERE rowid = %s', (recipe.id,))
+        cursor.execute(
+            f'INSERT INTO {RECIPE_FTS_TABLE} (rowid, name, text) '
+            'VALUES (%s, %s, %s)',
+            (recipe.id, recipe.name, recipe.text)
+        )
+
+
+def unindex_recipe(recipe_id):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {RECIPE_FTS_TABLE} WHERE rowid = %s', (recipe_id,))
+
+
+def rebuild_recipe_index():
+    """Перестраивает FTS5 целиком, например после bulk_create рецептов,
+    который не отправляет сигналы."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {RECIPE_FTS_TABLE}')
+        cursor.execute(
+            f'INSERT INTO {RECIPE_FTS_TABLE} (rowid, name, text) '
+            f'SELECT id, name, text FROM {Recipe._meta.db_table}'
+        )
@@ -1,17 +1,30 @@
 import base64
-
-from django.core.files.base import ContentFile
+import binascii
+from collections import Counter
+from io import BytesIO
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.files.uploadedfile import (
+    InMemoryUploadedFile,
+    TemporaryUploadedFile,
+)
 from django.core.validators import MinValueValidator
+from django.db import transaction
 from djoser.serializers import UserSerializer as DjoserUserSerializer
 from rest_framework import serializers
-from rest_framework.fields import SerializerMethodField
+from rest_framework.fields import SerializerMethodField, SkipField
 
+from .reference import INGREDIENTS, TAGS
+from .search import schedule_recipe_ingredient_index_invalidation
+from recipes.images import IMAGE_VARIANTS
 from recipes.models import (
     Favorite,
     Ingredient,
     Recipe,
     RecipeIngredient,
     ShoppingList,
+    ShoppingListIngredient,
     Subscription,
     Tag,
     User,
@@ -19,28 +32,166 @@ from recipes.models import (
 
 
 NO_IMAGE_MESSAGE = {'image': 'Это поле не может быть пустым.'}
+IMAGE_TYPE_MESSAGE = 'Допустимые типы изображений: {types}.'
+IMAGE_SIZE_MESSAGE = 'Размер изображения не должен превышать {limit} МБ.'
+IMAGE_SIGNATURE_MESSAGE = 'Содержимое файла не совпадает с типом изображения.'
+INVALID_BASE64_MESSAGE = 'Изображение должно быть закодировано в base64.'
 NO_TAGS_MESSAGE = {'tags': 'Нужно выбрать хотя бы один тег!'}
 SAME_TAGS_MESSAGE = 'Следующие теги не уникальны: {items}'
 NO_INGREDIENTS_MESSAGE = {
     'ingredients': 'Нужно выбрать хотя бы один ингердиент!'}
 SAME_INGREDIENTS_MESSAGE = 'Следующие ингредиенты не уникальны: {items}'
+NO_SUCH_TAGS_MESSAGE = 'Тегов с такими id нет: {items}'
+NO_SUCH_INGREDIENTS_MESSAGE = 'Ингредиентов с такими id нет: {items}'
 WRONG_AMOUNT_MESSAGE = {
     'amount': 'Количество ингредиента должно быть больше нуля!'}
+BULK_RECIPES_LIMIT = 100
+BASE64_WHITESPACE = ' \t\r\n'
+RECIPES_LIMIT_MESSAGE = {
+    'recipes_limit': 'Укажите целое неотрицательное число.'}
+
+
+def get_recipes_limit(request):
+    """Значение recipes_limit из запроса или None, если оно не задано."""
+    recipes_limit = request.query_params.get('recipes_limit')
+    if recipes_limit is None:
+        return None
+    try:
+        recipes_limit = int(recipes_limit)
+    except ValueError:
+        raise serializers.ValidationError(RECIPES_LIMIT_MESSAGE)
+    if recipes_limit < 0:
+        raise serializers.ValidationError(RECIPES_LIMIT_MESSAGE)
+    return recipes_limit
+
+
+class WrittenRelationListSerializer(serializers.ListSerializer):
+    """Связанные объекты рецепта; только что записанные сериализатором
+    рецепта берутся из context['written_relations'] без чтения из базы."""
+
+    def get_attribute(self, instance):
+        written_relations = self.context.get('written_relations', {})
+        if self.source in written_relations:
+            return written_relations[self.source]
+        return super().get_attribute(instance)
 
 
 class Base64ImageField(serializers.ImageField):
+    """Изображение в виде data URL: data:image/<тип>;base64,<данные>.
+
+    Тип и размер проверяются до декодирования, сигнатура файла — по первым
+    байтам, затем данные декодируются частями в память или во временный
+    файл (как при обычной загрузке файлов Django).
+    """
+    decode_chunk_size = 64 * 1024
+    image_signatures = {
+        'jpeg': (b'\xff\xd8\xff',),
+        'png': (b'\x89PNG\r\n\x1a\n',),
+        'gif': (b'GIF87a', b'GIF89a'),
+        'webp': (b'RIFF',),
+    }
+
+    def sniff_image_type(self, header):
+        for image_type, signatures in self.image_signatures.items():
+            if header.startswith(signatures):
+                if image_type == 'webp' and header[8:12] != b'WEBP':
+                    continue
+                return image_type
+        return None
+
+    def decode(self, data, start, image_type):
+        # Переносы строк (base64 в стиле MIME/PEM) не входят в размер и
+        # убираются из каждой части перед декодированием. Конец данных
+        # ищется с хвоста строки, чтобы не копировать ее целиком.
+        end = len(data)
+        while end > start and data[end - 1] in BASE64_WHITESPACE:
+            end -= 1
+        whitespace = sum(
+            data.count(char, start, end) for char in BASE64_WHITESPACE)
+        padding = data.count('=', max(start, end - 2), end)
+        size = (end - start - whitespace) * 3 // 4 - padding
+        if size > settings.RECIPE_IMAGE_MAX_SIZE:
+            raise serializers.ValidationError(IMAGE_SIZE_MESSAGE.format(
+                limit=settings.RECIPE_IMAGE_MAX_SIZE // 1024 // 1024))
+        file_class = (
+            InMemoryUploadedFile
+            if size <= settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+            else TemporaryUploadedFile
+        )
+        name = f'image.{image_type}'
+        content_type = f'image/{image_type}'
+        if file_class is InMemoryUploadedFile:
+            file = InMemoryUploadedFile(
+                BytesIO(), None, name, content_type, size, None)
+        else:
+            file = TemporaryUploadedFile(name, content_type, size, None)
+        # Декодируется только кратное 4 число символов, остаток переносится
+        # в следующую часть.
+        rest = ''
+        try:
+            for offset in range(start, end, self.decode_chunk_size):
+                chunk = rest + ''.join(
+                    data[offset:offset + self.decode_chunk_size].split())
+                length = len(chunk) - len(chunk) % 4
+                rest = chunk[length:]
+                chunk = base64.b64decode(chunk[:length])
+                if (
+                    offset == start
+                    and self.sniff_image_type(chunk[:12]) != image_type
+                ):
+                    raise serializers.ValidationError(
+                        IMAGE_SIGNATURE_MESSAGE)
+                file.write(chunk)
+        except binascii.Error:
+            raise serializers.ValidationError(INVALID_BASE64_MESSAGE)
+        if rest:
+            raise serializers.ValidationError(INVALID_BASE64_MESSAGE)
+        file.seek(0)
+        return file
+
+    def is_current_image(self, data):
+        instance = getattr(self.parent, 'instance', None)
+        image = getattr(instance, self.source, None)
+        return bool(image) and urlparse(data).path == urlparse(image.url).path
 
     def to_internal_value(self, data):
-        if isinstance(data, str) and data.startswith('data:image'):
-            format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
+        if isinstance(data, str) and data.startswith('data:image/'):
+            start = data.find(';base64,')
+            image_type = data[len('data:image/'):start].split(';')[0]
+            image_type = {'jpg': 'jpeg'}.get(image_type, image_type)
+            if start < 0 or image_type not in self.image_signatures:
+                raise serializers.ValidationError(IMAGE_TYPE_MESSAGE.format(
+                    types=', '.join(self.image_signatures)))
+            data = self.decode(data, start + len(';base64,'), image_type)
+        elif isinstance(data, str) and self.is_current_image(data):
+            raise SkipField
+        return super().to_internal_value(data)
 
-            data = ContentFile(
-                base64.b64decode(imgstr),
-                name=f'image.{ext}',
-            )
 
-        return super().to_internal_value(data)
+class ImageVariantsField(serializers.ReadOnlyField):
+    """Ссылки на уменьшенные копии изображения рецепта.
+
+    Пока копии не готовы, для всех вариантов отдается исходное изображение.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        super().__init__(**kwargs)
+
+    def to_representation(self, recipe):
+        if not recipe.image:
+            return None
+        request = self.context.get('request')
+        storage = recipe.image.storage
+        variants = {}
+        for name, _ in IMAGE_VARIANTS:
+            variant = recipe.image_variants.get(name)
+            url = storage.url(variant) if variant else recipe.image.url
+            variants[name] = (
+                request.build_absolute_uri(url) if request is not None
+                else url
+            )
+        return variants
 
 
 class UserSerializer(DjoserUserSerializer):
@@ -51,8 +202,10 @@ class UserSerializer(DjoserUserSerializer):
         fields = (*DjoserUserSerializer.Meta.fields, 'is_subscribed')
 
     def get_is_subscribed(self, author):
+        if hasattr(author, 'is_subscribed'):
+            return author.is_subscribed
         user = self.context.get('request').user
-        if user is None or user.is_anonymous:
+        if user is None or user.is_anonymous or user.id == author.id:
             return False
         return Subscription.objects.filter(
             user=user,
@@ -61,15 +214,18 @@ class UserSerializer(DjoserUserSerializer):
 
 
 class TagSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(read_only=True)
+    id = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Tag
         fields = ('id', 'name', 'color', 'slug')
 
+    def to_representation(self, tag):
+        return super().to_representation(TAGS.get(tag.id) or tag)
+
 
 class IngredientSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(read_only=True)
+    id = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Ingredient
@@ -77,11 +233,9 @@ class IngredientSerializer(serializers.ModelSerializer):
 
 
 class IngredientAmountSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(
-        read_only=True, source='ingredient.id')
-    name = serializers.ReadOnlyField(source='ingredient.name')
-    measurement_unit = serializers.ReadOnlyField(
-        source='ingredient.measurement_unit')
+    id = serializers.IntegerField(read_only=True, source='ingredient_id')
+    name = SerializerMethodField()
+    measurement_unit = SerializerMethodField()
     amount = serializers.IntegerField(
         read_only=True, validators=(MinValueValidator(1),))
 
@@ -89,10 +243,16 @@ class IngredientAmountSerializer(serializers.ModelSerializer):
         model = RecipeIngredient
         fields = ('id', 'name', 'measurement_unit', 'amount')
 
+    def get_name(self, recipe_ingredient):
+        return INGREDIENTS.get(recipe_ingredient.ingredient_id).name
+
+    def get_measurement_unit(self, recipe_ingredient):
+        return INGREDIENTS.get(
+            recipe_ingredient.ingredient_id).measurement_unit
+
 
 class IngredientWriteSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(queryset=Ingredient.objects.all(),
-                                            source='ingredient.id')
+    id = serializers.IntegerField(source='ingredient_id')
 
     class Meta:
         model = RecipeIngredient
@@ -102,8 +262,7 @@ class IngredientWriteSerializer(serializers.ModelSerializer):
 class RecipeWriteSerializer(serializers.ModelSerializer):
     ingredients = IngredientWriteSerializer(
         many=True)
-    tags = serializers.PrimaryKeyRelatedField(queryset=Tag.objects.all(),
-                                              many=True)
+    tags = serializers.ListField(child=serializers.IntegerField())
     image = Base64ImageField()
 
     class Meta:
@@ -117,64 +276,161 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
             'cooking_time',
         )
 
-    def not_unique_items_validation(self, items, message):
-        not_unique_items = set(item for item in items if items.count(item) > 1)
-        if not_unique_items:
-            raise serializers.ValidationError(
-                message.format(items=not_unique_items))
-        return items
+    def save(self, **kwargs):
+        try:
+            return super().save(**kwargs)
+        finally:
+            image = self.validated_data.get('image')
+            if image is not None:
+                image.close()
+
+    @staticmethod
+    def get_items_errors(ids, model, same_message, missing_message):
+        """Повторы и несуществующие id; все id проверяются одним
+        запросом."""
+        errors = []
+        same_ids = sorted(
+            pk for pk, count in Counter(ids).items() if count > 1)
+        if same_ids:
+            errors.append(same_message.format(items=same_ids))
+        found = model.objects.only('id').in_bulk(ids)
+        missing_ids = sorted({pk for pk in ids if pk not in found})
+        if missing_ids:
+            errors.append(missing_message.format(items=missing_ids))
+        return errors
 
     def validate(self, data):
-
         tags = data.get('tags')
         if not tags:
             raise serializers.ValidationError(NO_TAGS_MESSAGE)
-        self.not_unique_items_validation(tags, SAME_TAGS_MESSAGE)
         ingredients = data.get('ingredients')
         if not ingredients:
             raise serializers.ValidationError(NO_INGREDIENTS_MESSAGE)
-        self.not_unique_items_validation(
-            [ingredient['ingredient']['id'] for ingredient in ingredients],
-            SAME_INGREDIENTS_MESSAGE)
+        errors = {
+            field: field_errors for field, field_errors in (
+                ('tags', self.get_items_errors(
+                    tags, Tag, SAME_TAGS_MESSAGE, NO_SUCH_TAGS_MESSAGE)),
+                ('ingredients', self.get_items_errors(
+                    [ingredient['ingredient_id']
+                     for ingredient in ingredients],
+                    Ingredient,
+                    SAME_INGREDIENTS_MESSAGE,
+                    NO_SUCH_INGREDIENTS_MESSAGE
+                )),
+            ) if field_errors
+        }
+        if errors:
+            raise serializers.ValidationError(errors)
         return data
 
     def create_ingredients_amounts(self, recipe, ingredients):
-        RecipeIngredient.objects.bulk_create(RecipeIngredient(
-            ingredient=ingredient['ingredient']['id'],
+        return RecipeIngredient.objects.bulk_create(RecipeIngredient(
+            ingredient_id=ingredient['ingredient_id'],
             recipe=recipe,
             amount=ingredient.get("amount")
         ) for ingredient in ingredients)
 
+    def set_written_relations(self, recipe_ingredients, tags):
+        """Запоминает записанные продукты и теги, чтобы собрать ответ без
+        повторного чтения из базы."""
+        self.written_relations = {
+            'recipeingredients': recipe_ingredients,
+            'tags': sorted(
+                (Tag(id=pk) for pk in tags),
+                key=lambda tag: getattr(TAGS.get(tag.id), 'slug', '')
+            ),
+        }
+
     def create(self, validated_data):
         ingredients = validated_data.pop("ingredients")
         tags = validated_data.pop("tags")
         recipe = Recipe.objects.create(**validated_data)
-        self.create_ingredients_amounts(recipe, ingredients)
+        recipe_ingredients = self.create_ingredients_amounts(
+            recipe, ingredients)
+        schedule_recipe_ingredient_index_invalidation()
         recipe.tags.set(tags)
+        self.set_written_relations(recipe_ingredients, tags)
+        recipe.is_favorited = recipe.is_in_shopping_cart = False
         return recipe
 
+    @staticmethod
+    def update_ingredients_amounts(recipe, ingredients):
+        """Записывает только разницу между старыми и новыми продуктами
+        рецепта. Возвращает продукты рецепта в порядке их записи и
+        изменения {ingredient_id: (amount, count)} для списков покупок;
+        удаленные продукты вычитает из списков сигнал post_delete."""
+        rows = {
+            row.ingredient_id: row
+            for row in RecipeIngredient.objects.filter(recipe=recipe)
+        }
+        amounts = {
+            ingredient['ingredient_id']: ingredient['amount']
+            for ingredient in ingredients
+        }
+        changes = {}
+        removed = rows.keys() - amounts.keys()
+        changed_rows = []
+        for ingredient_id, amount in amounts.items():
+            row = rows.get(ingredient_id)
+            if row is None:
+                changes[ingredient_id] = (amount, 1)
+            elif row.amount != amount:
+                changes[ingredient_id] = (amount - row.amount, 0)
+                row.amount = amount
+                changed_rows.append(row)
+        if removed:
+            RecipeIngredient.objects.filter(
+                recipe=recipe, ingredient_id__in=removed).delete()
+        RecipeIngredient.objects.bulk_update(changed_rows, ('amount',))
+        new_rows = RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(
+                recipe=recipe, ingredient_id=ingredient_id, amount=amount)
+            for ingredient_id, amount in amounts.items()
+            if ingredient_id not in rows
+        )
+        kept_rows = sorted(
+            (row for row in rows.values() if row.ingredient_id in amounts),
+            key=lambda row: row.pk
+        )
+        return kept_rows + new_rows, changes
+
+    @transaction.atomic
     def update(self, recipe, validated_data):
-        ingredients = validated_data.pop("ingredients")
+        recipe_ingredients, changes = self.update_ingredients_amounts(
+            recipe, validated_data.pop("ingredients"))
         tags = validated_data.pop("tags")
-        RecipeIngredient.objects.filter(recipe=recipe).delete()
-        self.create_ingredients_amounts(recipe, ingredients)
         recipe.tags.set(tags)
+        self.set_written_relations(recipe_ingredients, tags)
+        if any(count for _, count in changes.values()):
+            schedule_recipe_ingredient_index_invalidation()
+        if changes:
+            ShoppingListIngredient.update_amounts(
+                ShoppingList.objects.filter(
+                    recipe=recipe).values_list('user_id', flat=True),
+                {pk: amount for pk, (amount, _) in changes.items()},
+                recipe_counts={pk: count for pk, (_, count) in changes.items()}
+            )
         return super().update(recipe, validated_data)
 
     def to_representation(self, recipe):
         return RecipeSerializer(
-            recipe, context=self.context
+            recipe,
+            context={
+                **self.context,
+                'written_relations': getattr(self, 'written_relations', {}),
+            }
         ).data
 
 
 class RecipeSerializer(serializers.ModelSerializer):
-    tags = TagSerializer(many=True)
+    tags = WrittenRelationListSerializer(child=TagSerializer())
     author = UserSerializer()
-    ingredients = IngredientAmountSerializer(
-        many=True, source='recipeingredients')
+    ingredients = WrittenRelationListSerializer(
+        child=IngredientAmountSerializer(), source='recipeingredients')
     is_favorited = SerializerMethodField()
     is_in_shopping_cart = SerializerMethodField()
     image = Base64ImageField()
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Recipe
@@ -187,35 +443,74 @@ class RecipeSerializer(serializers.ModelSerializer):
             'is_in_shopping_cart',
             'name',
             'image',
+            'image_variants',
             'text',
-            'cooking_time'
+            'cooking_time',
+            'favorites_count',
+            'in_carts_count',
         )
 
-    def get_is_favorited(self, obj):
+    def get_user_recipe_flag(self, recipe, name, model):
+        if hasattr(recipe, name):
+            return getattr(recipe, name)
         user = self.context.get('request').user
         if user is None or user.is_anonymous:
             return False
-        return Favorite.objects.filter(recipe=obj, user=user).exists()
+        return model.objects.filter(recipe=recipe, user=user).exists()
+
+    def get_is_favorited(self, obj):
+        return self.get_user_recipe_flag(obj, 'is_favorited', Favorite)
 
     def get_is_in_shopping_cart(self, obj):
-        user = self.context.get('request').user
-        if user is None or user.is_anonymous:
-            return False
-        return ShoppingList.objects.filter(recipe=obj, user=user).exists()
+        return self.get_user_recipe_flag(
+            obj, 'is_in_shopping_cart', ShoppingList)
+
+
+class RecipeCoverageSerializer(RecipeSerializer):
+    coverage = serializers.FloatField(read_only=True)
+    matched_ingredients = serializers.IntegerField(read_only=True)
+
+    class Meta(RecipeSerializer.Meta):
+        fields = (
+            *RecipeSerializer.Meta.fields, 'coverage', 'matched_ingredients')
 
 
 class ShortRecipeSerializer(serializers.ModelSerializer):
+    image_variants = ImageVariantsField()
 
     class Meta():
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_variants', 'cooking_time')
         read_only_fields = ('id', 'name', 'image', 'cooking_time')
 
 
+class ShoppingListIngredientSerializer(serializers.Serializer):
+    id = serializers.IntegerField(source='ingredient')
+    name = serializers.CharField(source='ingredient__name')
+    measurement_unit = serializers.CharField(
+        source='ingredient__measurement_unit')
+    amount = serializers.IntegerField()
+
+
+class ShoppingListSummarySerializer(serializers.Serializer):
+    recipes = ShortRecipeSerializer(many=True)
+    ingredients = ShoppingListIngredientSerializer(many=True)
+
+
+class RecipeIdsSerializer(serializers.Serializer):
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=BULK_RECIPES_LIMIT
+    )
+
+    def validate_recipes(self, recipes):
+        return list(dict.fromkeys(recipes))
+
+
 class SubscriptionSerializer(UserSerializer):
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.ReadOnlyField(
-        source='recipes.count')
+    recipes_count = serializers.SerializerMethodField()
 
     class Meta:
         model = User
@@ -223,13 +518,19 @@ class SubscriptionSerializer(UserSerializer):
         read_only_fields = ("email", "username", "first_name", "last_name")
 
     def get_recipes(self, obj):
-        limit = int(self.context.get(
-            "request").GET.get('recipes_limit', 10**10))
+        if hasattr(obj, 'preview_recipes'):
+            recipes = obj.preview_recipes
+        else:
+            limit = get_recipes_limit(self.context.get("request"))
+            recipes = obj.recipes.all()[:limit]
         return ShortRecipeSerializer(
-            obj.recipes.all()[: limit], many=True, read_only=True
+            recipes, many=True, read_only=True
         ).data
 
+    def get_recipes_count(self, obj):
+        if hasattr(obj, 'recipes_count'):
+            return obj.recipes_count
+        return obj.recipes.count()
+
     def get_is_subscribed(self, obj):
-        return Subscription.objects.filter(
-            author=obj, user=self.context.get('request').user
-        ).exists()
+        return True
@@ -0,0 +1,132 @@
+from threading import local
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .reference import INGREDIENTS, TAGS
+from .search import (
+    index_recipe,
+    schedule_recipe_ingredient_index_invalidation,
+    unindex_recipe,
+)
+from recipes.images import schedule_image_variants
+from recipes.models import (
+    FeedItem,
+    Ingredient,
+    Recipe,
+    RecipeIngredient,
+    ReferenceVersion,
+    ShoppingList,
+    ShoppingListIngredient,
+    Subscription,
+    Tag,
+    User,
+)
+
+pending_recipes_changed = local()
+pending_shopping_lists = local()
+
+
+@receiver((post_save, post_delete), sender=Tag)
+def tag_changed(**kwargs):
+    ReferenceVersion.bump(ReferenceVersion.TAGS)
+    TAGS.invalidate()
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def ingredient_changed(**kwargs):
+    ReferenceVersion.bump(ReferenceVersion.INGREDIENTS)
+    INGREDIENTS.invalidate()
+
+
+@receiver((post_save, post_delete), sender=RecipeIngredient)
+def recipe_ingredient_written(using, **kwargs):
+    # bulk_create сигналов не отправляет: о добавленных продуктах
+    # сериализатор рецепта сообщает сам.
+    schedule_recipe_ingredient_index_invalidation(using)
+    schedule_recipes_changed(using)
+
+
+def recipes_changed():
+    if getattr(pending_recipes_changed, 'scheduled', False):
+        pending_recipes_changed.scheduled = False
+        ReferenceVersion.bump(ReferenceVersion.RECIPES)
+
+
+def schedule_recipes_changed(using=None):
+    """Увеличивает версию рецептов один раз после фиксации транзакции.
+
+    Версия входит в ETag и Last-Modified списков рецептов: меняется
+    при создании, изменении и удалении рецептов и их продуктов, а также
+    при изменении профилей авторов. Теги рецепта меняются вместе с
+    сохранением самого рецепта: получатель m2m_changed отключил бы
+    быструю запись тегов без лишнего запроса.
+    """
+    pending_recipes_changed.scheduled = True
+    transaction.on_commit(recipes_changed, using=using)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_saved(instance, using, update_fields=None, **kwargs):
+    schedule_recipes_changed(using)
+    if update_fields is None or {'name', 'text'} & set(update_fields):
+        index_recipe(instance)
+    if (
+        instance.image
+        and instance.image_variants.get('source') != instance.image.name
+    ):
+        schedule_image_variants(instance)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(instance, using, **kwargs):
+    schedule_recipes_changed(using)
+    unindex_recipe(instance.id)
+
+
+@receiver(post_save, sender=User)
+def user_saved(created, using, update_fields=None, **kwargs):
+    # Вход обновляет только last_login, который в ответах не виден.
+    if not created and update_fields != frozenset(('last_login',)):
+        schedule_recipes_changed(using)
+
+
+def get_pending_shopping_lists():
+    if not hasattr(pending_shopping_lists, 'users'):
+        pending_shopping_lists.users = set()
+        pending_shopping_lists.recipes = set()
+    return pending_shopping_lists
+
+
+def refresh_shopping_lists():
+    pending = get_pending_shopping_lists()
+    user_ids, recipe_ids = set(pending.users), set(pending.recipes)
+    pending.users.clear()
+    pending.recipes.clear()
+    if recipe_ids:
+        user_ids.update(ShoppingList.objects.filter(
+            recipe_id__in=recipe_ids).values_list('user_id', flat=True))
+    ShoppingListIngredient.refresh(user_ids)
+
+
+# Удаления (в том числе каскадные и из админки) и продукты рецептов,
+# записанные по одному (админка, ORM), копятся до конца транзакции,
+# затем затронутые списки покупок пересчитываются один раз.
+# Сериализатор рецепта пишет продукты пакетно, без сигналов, и
+# обновляет списки покупок сам.
+@receiver(post_delete, sender=ShoppingList)
+def shopping_list_deleted(instance, using, **kwargs):
+    get_pending_shopping_lists().users.add(instance.user_id)
+    transaction.on_commit(refresh_shopping_lists, using=using)
+
+
+@receiver((post_save, post_delete), sender=RecipeIngredient)
+def recipe_ingredient_changed(instance, using, **kwargs):
+    get_pending_shopping_lists().recipes.add(instance.recipe_id)
+    transaction.on_commit(refresh_shopping_lists, using=using)
+
+
+@receiver(post_delete, sender=Subscription)
+def subscription_deleted(instance, **kwargs):
+    FeedItem.backfill_subscribers(instance.author_id)
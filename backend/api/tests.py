@@ -0,0 +1,1086 @@
+import base64
+import os
+import random
+import shutil
+import tempfile
+import textwrap
+from datetime import timedelta
+from functools import partial
+from io import BytesIO, StringIO
+
+from django.core.files.base import ContentFile
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.utils import timezone
+from PIL import Image
+from rest_framework import serializers
+from rest_framework.test import APIClient
+
+from .middleware import QueryBudgetExceeded, QueryBudgetMiddleware
+from .reference import INGREDIENTS, TAGS
+from .search import RECIPE_INGREDIENT_INDEX, RecipeIngredientIndex
+from .serializers import Base64ImageField, RecipeWriteSerializer
+from recipes.management.commands import clean_media
+from recipes.similarity import build_similar_recipes
+from recipes.models import (
+    Favorite,
+    FeedItem,
+    Ingredient,
+    Recipe,
+    RecipeIngredient,
+    ReferenceVersion,
+    ShoppingList,
+    ShoppingListIngredient,
+    SimilarRecipe,
+    Subscription,
+    Tag,
+    User,
+)
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def make_png(width=400, height=300):
+    """PNG из случайных пикселей: почти не сжимается (~360 КБ)."""
+    size = width * height * 3
+    buffer = BytesIO()
+    Image.frombytes(
+        'RGB',
+        (width, height),
+        random.Random(0).getrandbits(size * 8).to_bytes(size, 'little')
+    ).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def make_data_url(content, line_length=None):
+    encoded = base64.b64encode(content).decode()
+    if line_length is not None:
+        encoded = '\n'.join(textwrap.wrap(encoded, line_length)) + '\n'
+    return f'data:image/png;base64,{encoded}'
+
+
+class Base64ImageFieldTest(SimpleTestCase):
+
+    def decode(self, data, chunk_size=None):
+        field = Base64ImageField()
+        if chunk_size is not None:
+            field.decode_chunk_size = chunk_size
+        return field.to_internal_value(data)
+
+    def test_plain_payload(self):
+        content = make_png()
+        self.assertEqual(self.decode(make_data_url(content)).read(), content)
+
+    def test_line_wrapped_payload(self):
+        content = make_png()
+        for chunk_size in (None, 1000, 77):
+            with self.subTest(chunk_size=chunk_size):
+                image = self.decode(
+                    make_data_url(content, line_length=76), chunk_size)
+                self.assertEqual(image.read(), content)
+
+    def test_trailing_whitespace(self):
+        content = make_png()
+        image = self.decode(make_data_url(content) + ' \r\n\r\n')
+        self.assertEqual(image.size, len(content))
+        self.assertEqual(image.read(), content)
+
+    def test_truncated_payload(self):
+        data = make_data_url(make_png())
+        with self.assertRaises(serializers.ValidationError):
+            self.decode(data[:-3])
+
+
+def create_user(number):
+    return User.objects.create_user(
+        username=f'user{number}',
+        email=f'user{number}@example.com',
+        first_name='Имя',
+        last_name='Фамилия',
+        password='password',
+    )
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, REFERENCE_CACHE_TIMEOUT=3600)
+class RecipeQueriesTest(TestCase):
+    """Число запросов к базе не зависит от числа рецептов, тегов
+    и продуктов в ответе."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user(1)
+        cls.author = create_user(2)
+        Subscription.objects.create(user=cls.user, author=cls.author)
+        cls.tags = [
+            Tag.objects.create(
+                name=f'Тег {number}', color='#FF0000', slug=f'tag{number}')
+            for number in range(3)
+        ]
+        cls.ingredients = [
+            Ingredient.objects.create(
+                name=f'Продукт {number}', measurement_unit='г')
+            for number in range(5)
+        ]
+        for number in range(4):
+            recipe = Recipe.objects.create(
+                author=cls.author,
+                name=f'Рецепт {number}',
+                text='Текст',
+                cooking_time=10,
+                image='recipes/images/test.png',
+            )
+            recipe.tags.set(cls.tags[:2])
+            RecipeIngredient.objects.bulk_create(
+                RecipeIngredient(
+                    recipe=recipe, ingredient=ingredient, amount=100)
+                for ingredient in cls.ingredients[:3]
+            )
+        cls.recipe = recipe
+        Favorite.objects.create(user=cls.user, recipe=recipe)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        TAGS.refresh(force=True)
+        INGREDIENTS.refresh(force=True)
+
+    def test_list(self):
+        with self.assertNumQueries(7):
+            response = self.client.get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 4)
+
+    def test_retrieve(self):
+        with self.assertNumQueries(6):
+            response = self.client.get(f'/api/recipes/{self.recipe.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['is_favorited'])
+
+    def test_create(self):
+        data = {
+            'name': 'Новый рецепт',
+            'text': 'Текст',
+            'cooking_time': 5,
+            'image': make_data_url(make_png(8, 8)),
+            'tags': [tag.id for tag in self.tags],
+            'ingredients': [
+                {'id': ingredient.id, 'amount': 10}
+                for ingredient in self.ingredients
+            ],
+        }
+        with self.assertNumQueries(12):
+            response = self.client.post('/api/recipes/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['ingredients']), 5)
+
+    def test_update_returns_written_relations(self):
+        self.client.force_authenticate(self.author)
+        response = self.client.patch(
+            f'/api/recipes/{self.recipe.id}/',
+            {
+                'tags': [self.tags[2].id],
+                'ingredients': [{'id': self.ingredients[4].id, 'amount': 7}],
+            },
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [tag['id'] for tag in response.data['tags']], [self.tags[2].id])
+        self.assertEqual(
+            [
+                (ingredient['id'], ingredient['amount'])
+                for ingredient in response.data['ingredients']
+            ],
+            [(self.ingredients[4].id, 7)]
+        )
+
+
+class RecipeListEtagTest(TestCase):
+    """Валидаторы списка рецептов меняются вместе с версией рецептов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user(1)
+        cls.author = create_user(2)
+        cls.recipes = [
+            Recipe.objects.create(
+                author=cls.author,
+                name=f'Рецепт {number}',
+                text='Текст',
+                cooking_time=10,
+                image='recipes/images/test.png',
+            )
+            for number in range(2)
+        ]
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def get_response(self):
+        response = self.client.get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def assertEtagChanged(self, change):
+        etag = self.get_response()['ETag']
+        self.assertEqual(
+            self.client.get(
+                '/api/recipes/', HTTP_IF_NONE_MATCH=etag).status_code,
+            304
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+        response = self.get_response()
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('Last-Modified', response)
+
+    def test_author_changed(self):
+        def change():
+            self.author.first_name = 'Другое'
+            self.author.save()
+        self.assertEtagChanged(change)
+
+    def test_recipe_deleted(self):
+        self.assertEtagChanged(self.recipes[0].delete)
+
+    def test_counter_changed(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEtagChanged(partial(
+            client.post, f'/api/recipes/{self.recipes[0].id}/favorite/'))
+
+
+@override_settings(REFERENCE_CACHE_TIMEOUT=3600)
+class ReferenceCacheTest(TestCase):
+    """Промахи по id не перечитывают справочник."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ingredient = Ingredient.objects.create(
+            name='Соль', measurement_unit='г')
+
+    def setUp(self):
+        INGREDIENTS.refresh(force=True)
+        INGREDIENTS.missed_at = None
+
+    def test_missing(self):
+        url = f'/api/ingredients/{self.ingredient.id + 1}/'
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url).status_code, 404)
+        for _ in range(3):
+            with self.assertNumQueries(0):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_created_in_other_process(self):
+        # bulk_create не отправляет сигналов: кэш этого процесса
+        # узнает о продукте только по версии справочника.
+        Ingredient.objects.bulk_create(
+            (Ingredient(name='Перец', measurement_unit='г'),))
+        ReferenceVersion.bump(ReferenceVersion.INGREDIENTS)
+        ingredient = Ingredient.objects.get(name='Перец')
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/api/ingredients/{ingredient.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['name'], 'Перец')
+
+
+class RecipeValidationQueriesTest(TestCase):
+    """Теги и продукты рецепта проверяются одним запросом каждые,
+    сколько бы их ни было."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tag_ids = [
+            Tag.objects.create(
+                name=f'Тег {number}', color='#FF0000', slug=f'tag{number}'
+            ).id
+            for number in range(10)
+        ]
+        cls.ingredient_ids = [
+            Ingredient.objects.create(
+                name=f'Продукт {number}', measurement_unit='г'
+            ).id
+            for number in range(50)
+        ]
+
+    def validate(self, tag_ids, ingredient_ids):
+        return RecipeWriteSerializer().validate({
+            'tags': tag_ids,
+            'ingredients': [
+                {'ingredient_id': pk, 'amount': 1} for pk in ingredient_ids
+            ],
+        })
+
+    def test_valid(self):
+        with self.assertNumQueries(2):
+            self.validate(self.tag_ids, self.ingredient_ids)
+
+    def test_duplicate_and_missing(self):
+        missing_id = max(self.ingredient_ids) + 1
+        with self.assertNumQueries(2):
+            with self.assertRaises(serializers.ValidationError) as error:
+                self.validate(
+                    [*self.tag_ids, self.tag_ids[0]],
+                    [*self.ingredient_ids, missing_id, missing_id]
+                )
+        self.assertEqual(set(error.exception.detail), {'tags', 'ingredients'})
+        self.assertEqual(len(error.exception.detail['ingredients']), 2)
+
+
+class RecipeSearchTest(TestCase):
+    """Поиск по рецептам, в том числе когда отфильтрованные рецепты
+    становятся подзапросом ленты подписок."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user(1)
+        cls.author = create_user(2)
+        cls.other = create_user(3)
+        cls.pancakes, cls.soup, cls.other_pancakes = (
+            Recipe.objects.create(
+                author=author,
+                name=name,
+                text=text,
+                cooking_time=10,
+                image='recipes/images/test.png',
+            )
+            for author, name, text in (
+                (cls.author, 'Блины на молоке', 'Тонкие'),
+                (cls.author, 'Суп', 'Подавать с блинами'),
+                (cls.other, 'Блины', 'Толстые'),
+            )
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.client.post(f'/api/users/{self.author.id}/subscribe/')
+
+    def get_ids(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_list(self):
+        self.assertEqual(
+            self.get_ids('/api/recipes/?search=блин'),
+            [self.other_pancakes.id, self.pancakes.id, self.soup.id]
+        )
+
+    def test_feed(self):
+        self.assertEqual(
+            self.get_ids('/api/recipes/feed/?search=блин'),
+            [self.soup.id, self.pancakes.id]
+        )
+        self.assertEqual(
+            self.get_ids('/api/recipes/feed/?search=суп'), [self.soup.id])
+
+    @override_settings(FEED_FANOUT_MAX_SUBSCRIBERS=0)
+    def test_feed_pull_author(self):
+        self.assertEqual(
+            self.get_ids('/api/recipes/feed/?search=блин'),
+            [self.soup.id, self.pancakes.id]
+        )
+
+
+def create_recipe(author, ingredients, name='Рецепт'):
+    # Уменьшенные копии отмечены готовыми: файла изображения нет.
+    recipe = Recipe.objects.create(
+        author=author,
+        name=name,
+        text='Текст',
+        cooking_time=10,
+        image='recipes/images/test.png',
+        image_variants={'source': 'recipes/images/test.png'},
+    )
+    RecipeIngredient.objects.bulk_create(
+        RecipeIngredient(recipe=recipe, ingredient=ingredient, amount=amount)
+        for ingredient, amount in ingredients
+    )
+    return recipe
+
+
+def check_shopping_lists():
+    """Агрегат списков покупок совпадает с рецептами."""
+    call_command('rebuild_shopping_lists', check=True, stdout=StringIO())
+
+
+class BulkUserRecipesTest(TestCase):
+    """Пакетное добавление и удаление рецептов в избранном и списке
+    покупок: статусы по id, счетчики рецептов и агрегат покупок."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user(1)
+        author = create_user(2)
+        cls.salt, cls.sugar = (
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('Соль', 'Сахар')
+        )
+        cls.first = create_recipe(author, ((cls.salt, 5), (cls.sugar, 10)))
+        cls.second = create_recipe(author, ((cls.salt, 3),))
+        cls.third = create_recipe(author, ((cls.sugar, 1),))
+        cls.missing_id = cls.third.id + 1
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def request(self, method, url, recipes):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = getattr(self.client, method)(
+                url, {'recipes': recipes}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return [
+            (result['id'], result['status'])
+            for result in response.data['results']
+        ]
+
+    def get_counters(self, field):
+        return dict(Recipe.objects.values_list('id', field))
+
+    def get_amounts(self):
+        return dict(ShoppingListIngredient.objects.filter(
+            user=self.user
+        ).values_list('ingredient', 'total_amount'))
+
+    def test_shopping_cart(self):
+        url = '/api/recipes/shopping_cart/'
+        self.client.post(f'/api/recipes/{self.first.id}/shopping_cart/')
+        self.assertEqual(
+            self.request(
+                'post',
+                url,
+                [self.first.id, self.second.id, self.missing_id,
+                 self.second.id]
+            ),
+            [
+                (self.first.id, 'already_added'),
+                (self.second.id, 'added'),
+                (self.missing_id, 'not_found'),
+            ]
+        )
+        self.assertEqual(
+            self.get_counters('in_carts_count'),
+            {self.first.id: 1, self.second.id: 1, self.third.id: 0}
+        )
+        self.assertEqual(
+            self.get_amounts(), {self.salt.id: 8, self.sugar.id: 10})
+        check_shopping_lists()
+        self.assertEqual(
+            self.request('delete', url, [self.first.id, self.third.id]),
+            [(self.first.id, 'deleted'), (self.third.id, 'not_added')]
+        )
+        self.assertEqual(
+            self.get_counters('in_carts_count'),
+            {self.first.id: 0, self.second.id: 1, self.third.id: 0}
+        )
+        self.assertEqual(self.get_amounts(), {self.salt.id: 3})
+        check_shopping_lists()
+
+    def test_favorites(self):
+        url = '/api/recipes/favorite/'
+        self.assertEqual(
+            self.request('post', url, [self.first.id, self.third.id]),
+            [(self.first.id, 'added'), (self.third.id, 'added')]
+        )
+        self.assertEqual(
+            self.request('delete', url, [self.third.id, self.missing_id]),
+            [(self.third.id, 'deleted'), (self.missing_id, 'not_found')]
+        )
+        self.assertEqual(
+            self.get_counters('favorites_count'),
+            {self.first.id: 1, self.second.id: 0, self.third.id: 0}
+        )
+        self.assertFalse(ShoppingList.objects.exists())
+
+
+class ShoppingListAggregateTest(TestCase):
+    """Агрегат списков покупок следует за изменениями рецептов, в том
+    числе сделанными в обход API."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user(1)
+        cls.author = create_user(2)
+        cls.salt, cls.sugar, cls.flour = (
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('Соль', 'Сахар', 'Мука')
+        )
+        cls.tag = Tag.objects.create(
+            name='Завтрак', color='#FF0000', slug='breakfast')
+        cls.recipe = create_recipe(
+            cls.author, ((cls.salt, 5), (cls.sugar, 10)))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                f'/api/recipes/{self.recipe.id}/shopping_cart/')
+
+    def assertAmounts(self, amounts):
+        self.assertEqual(
+            dict(ShoppingListIngredient.objects.filter(
+                user=self.user
+            ).values_list('ingredient', 'total_amount')),
+            amounts
+        )
+        check_shopping_lists()
+
+    def test_ingredients_changed_outside_api(self):
+        self.assertAmounts({self.salt.id: 5, self.sugar.id: 10})
+        with self.captureOnCommitCallbacks(execute=True):
+            RecipeIngredient.objects.create(
+                recipe=self.recipe, ingredient=self.flour, amount=200)
+            row = RecipeIngredient.objects.get(
+                recipe=self.recipe, ingredient=self.salt)
+            row.amount = 7
+            row.save()
+        self.assertAmounts(
+            {self.salt.id: 7, self.sugar.id: 10, self.flour.id: 200})
+        with self.captureOnCommitCallbacks(execute=True):
+            RecipeIngredient.objects.filter(ingredient=self.sugar).delete()
+        self.assertAmounts({self.salt.id: 7, self.flour.id: 200})
+
+    def test_recipe_updated(self):
+        self.client.force_authenticate(self.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                f'/api/recipes/{self.recipe.id}/',
+                {
+                    'tags': [self.tag.id],
+                    'ingredients': [
+                        {'id': self.salt.id, 'amount': 1},
+                        {'id': self.flour.id, 'amount': 300},
+                    ],
+                },
+                format='json'
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertAmounts({self.salt.id: 1, self.flour.id: 300})
+
+    def test_deleted(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.salt.delete()
+        self.assertAmounts({self.sugar.id: 10})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipe.delete()
+        self.assertAmounts({})
+
+    def test_check_reports_mismatches(self):
+        ShoppingListIngredient.objects.filter(
+            ingredient=self.salt).update(total_amount=1)
+        with self.assertRaises(CommandError):
+            check_shopping_lists()
+        call_command('rebuild_shopping_lists', stdout=StringIO())
+        self.assertAmounts({self.salt.id: 5, self.sugar.id: 10})
+
+
+class SimilarRecipesTest(TestCase):
+    """Пересчет только измененных рецептов дает ту же таблицу похожих,
+    что и полный расчет."""
+
+    @classmethod
+    def setUpTestData(cls):
+        author = create_user(1)
+        ingredients = [
+            Ingredient.objects.create(
+                name=f'Продукт {number}', measurement_unit='г')
+            for number in range(6)
+        ]
+        tags = [
+            Tag.objects.create(
+                name=f'Тег {number}', color='#FF0000', slug=f'tag{number}')
+            for number in range(2)
+        ]
+        cls.recipes = []
+        for number in range(24):
+            recipe = create_recipe(
+                author,
+                {
+                    (ingredients[index % 6], 1)
+                    for index in (number, number + 1, number * 2)
+                },
+                name=f'Рецепт {number}'
+            )
+            recipe.tags.set(tags[:number % 3])
+            cls.recipes.append(recipe)
+
+    def get_table(self):
+        return {
+            (recipe_id, similar_id): round(score, 9)
+            for recipe_id, similar_id, score
+            in SimilarRecipe.objects.values_list('recipe', 'similar', 'score')
+        }
+
+    def assertSameAsFull(self):
+        build_similar_recipes()
+        incremental = self.get_table()
+        build_similar_recipes(full=True)
+        self.assertEqual(incremental, self.get_table())
+
+    def test_recipe_deleted(self):
+        build_similar_recipes(full=True)
+        self.recipes[3].delete()
+        self.assertSameAsFull()
+
+    def test_recipe_changed(self):
+        build_similar_recipes(full=True)
+        RecipeIngredient.objects.filter(recipe=self.recipes[5]).delete()
+        Recipe.objects.filter(pk=self.recipes[5].pk).update(
+            content_updated_at=timezone.now())
+        self.assertSameAsFull()
+
+
+class RecipesByIngredientsTest(TestCase):
+    """Подбор рецептов по продуктам: порядок по доле имеющихся
+    продуктов и постраничная выдача."""
+
+    @classmethod
+    def setUpTestData(cls):
+        author = create_user(1)
+        cls.salt, cls.sugar, cls.flour = (
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('Соль', 'Сахар', 'Мука')
+        )
+        cls.salty = create_recipe(author, ((cls.salt, 1),))
+        cls.sweet = create_recipe(
+            author, ((cls.sugar, 1), (cls.flour, 1)))
+        cls.mixed = create_recipe(
+            author, ((cls.salt, 1), (cls.sugar, 1), (cls.flour, 1)))
+
+    def setUp(self):
+        RECIPE_INGREDIENT_INDEX.refresh(force=True)
+
+    def get(self, query):
+        response = self.client.get(
+            f'/api/recipes/by_ingredients/?{query}')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_pages(self):
+        ingredients = f'ingredients={self.salt.id},{self.sugar.id}'
+        data = self.get(f'{ingredients}&limit=2')
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(
+            [
+                (recipe['id'], recipe['matched_ingredients'])
+                for recipe in data['results']
+            ],
+            [(self.salty.id, 1), (self.mixed.id, 2)]
+        )
+        self.assertEqual(data['results'][1]['coverage'], 2 / 3)
+        data = self.get(f'{ingredients}&limit=2&page=2')
+        self.assertEqual(
+            [recipe['id'] for recipe in data['results']], [self.sweet.id])
+
+    def test_unknown_ingredient(self):
+        data = self.get(f'ingredients={self.flour.id + 1}')
+        self.assertEqual((data['count'], data['results']), (0, []))
+
+
+class RecipeIngredientIndexReloadTest(TransactionTestCase):
+    """Измененный индекс перечитывается в фоне, а до этого запросы
+    получают прежний."""
+
+    def test_reload(self):
+        salt = Ingredient.objects.create(name='Соль', measurement_unit='г')
+        recipe = create_recipe(create_user(1), ())
+        index = RecipeIngredientIndex()
+        index.refresh(force=True)
+        RecipeIngredient.objects.create(
+            recipe=recipe, ingredient=salt, amount=1)
+        ReferenceVersion.bump(ReferenceVersion.RECIPE_INGREDIENTS)
+        index.refresh(check=True)
+        index.rebuild.result()
+        self.assertEqual(index.search([salt.id])[:], [(recipe.id, 1.0, 1)])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class MediaStorageTest(TestCase):
+    """Повторная загрузка файла продлевает его жизнь: clean_media не
+    удаляет файлы, на которые ссылаются рецепты или которые загружены
+    недавно."""
+
+    def setUp(self):
+        self.storage = Recipe._meta.get_field('image').storage
+        self.author = create_user(1)
+
+    def save(self, content, folder='recipes/images/'):
+        return self.storage.save(f'{folder}image.png', ContentFile(content))
+
+    def make_old(self, name):
+        os.utime(self.storage.path(name), (0, 0))
+
+    def clean_media(self):
+        call_command('clean_media', stdout=StringIO())
+
+    def test_same_content_refreshes_mtime(self):
+        name = self.save(b'first')
+        self.make_old(name)
+        self.assertEqual(self.save(b'first'), name)
+        self.assertGreater(os.path.getmtime(self.storage.path(name)), 0)
+        self.clean_media()
+        self.assertTrue(self.storage.exists(name))
+
+    def test_clean_media(self):
+        image, variant, unused, young = (
+            self.save(b'image'),
+            self.save(b'variant', 'recipes/variants/'),
+            self.save(b'unused'),
+            self.save(b'young'),
+        )
+        for name in (image, variant, unused):
+            self.make_old(name)
+        Recipe.objects.create(
+            author=self.author,
+            name='Рецепт',
+            text='Текст',
+            cooking_time=10,
+            image=image,
+            image_variants={'source': image, 'thumb': variant},
+        )
+        self.clean_media()
+        self.assertEqual(
+            [
+                self.storage.exists(name)
+                for name in (image, variant, unused, young)
+            ],
+            [True, True, False, True]
+        )
+
+    def test_referenced_after_listing(self):
+        name = self.save(b'image')
+        self.make_old(name)
+        Recipe.objects.create(
+            author=self.author,
+            name='Рецепт',
+            text='Текст',
+            cooking_time=10,
+            image=name,
+            image_variants={'source': name},
+        )
+        # Рецепт сохранен уже после того, как команда прочитала ссылки.
+        command = clean_media.Command(stdout=StringIO())
+        command.get_referenced_names = set
+        call_command(command)
+        self.assertTrue(self.storage.exists(name))
+
+
+@override_settings(
+    MEDIA_ROOT=MEDIA_ROOT,
+    QUERY_BUDGET_ENABLED=True,
+    QUERY_BUDGET_STRICT=True,
+)
+class QueryBudgetTest(TestCase):
+    """Основные эндпоинты укладываются в бюджеты QUERY_BUDGETS и не
+    содержат N+1 на нескольких рецептах, тегах и продуктах."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user(1)
+        cls.author = create_user(2)
+        Subscription.objects.create(user=cls.user, author=cls.author)
+        cls.tags = [
+            Tag.objects.create(
+                name=f'Тег {number}', color='#FF0000', slug=f'tag{number}')
+            for number in range(3)
+        ]
+        cls.ingredients = [
+            Ingredient.objects.create(
+                name=f'Продукт {number}', measurement_unit='г')
+            for number in range(6)
+        ]
+        cls.recipes = []
+        for number in range(6):
+            recipe = create_recipe(
+                cls.author,
+                ((ingredient, 10) for ingredient in cls.ingredients[:4]),
+                name=f'Рецепт {number}'
+            )
+            recipe.tags.set(cls.tags)
+            FeedItem.objects.create(
+                user=cls.user, recipe=recipe, pub_date=recipe.pub_date)
+            cls.recipes.append(recipe)
+        for model in (Favorite, ShoppingList):
+            for recipe in cls.recipes[:5]:
+                model.objects.create(user=cls.user, recipe=recipe)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        TAGS.refresh(force=True)
+        INGREDIENTS.refresh(force=True)
+        RECIPE_INGREDIENT_INDEX.refresh(force=True)
+
+    def test_read_endpoints(self):
+        recipe = self.recipes[0]
+        for url in (
+            '/api/tags/',
+            f'/api/tags/{self.tags[0].id}/',
+            '/api/ingredients/',
+            '/api/ingredients/?name=Прод',
+            f'/api/ingredients/{self.ingredients[0].id}/',
+            '/api/recipes/',
+            '/api/recipes/?pagination=cursor',
+            '/api/recipes/?is_favorited=1&is_in_shopping_cart=1',
+            f'/api/recipes/?tags={self.tags[0].slug}',
+            '/api/recipes/?search=рецепт',
+            f'/api/recipes/{recipe.id}/',
+            f'/api/recipes/{recipe.id}/similar/',
+            '/api/recipes/feed/',
+            '/api/recipes/trending/',
+            f'/api/recipes/by_ingredients/?ingredients='
+            f'{self.ingredients[0].id}',
+            '/api/recipes/shopping_cart/summary/',
+            '/api/recipes/download_shopping_cart/',
+            '/api/users/',
+            f'/api/users/{self.author.id}/',
+            '/api/users/me/',
+            '/api/users/subscriptions/',
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_write_endpoints(self):
+        recipe = self.recipes[5]
+        for url, data, status in (
+            (f'/api/recipes/{recipe.id}/favorite/', None, 201),
+            (f'/api/recipes/{recipe.id}/shopping_cart/', None, 201),
+            ('/api/recipes/favorite/',
+             {'recipes': [recipe.id for recipe in self.recipes]}, 200),
+            ('/api/recipes/', {
+                'name': 'Новый рецепт',
+                'text': 'Текст',
+                'cooking_time': 5,
+                'image': make_data_url(make_png(8, 8)),
+                'tags': [tag.id for tag in self.tags],
+                'ingredients': [
+                    {'id': ingredient.id, 'amount': 10}
+                    for ingredient in self.ingredients
+                ],
+            }, 201),
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(
+                    self.client.post(url, data, format='json').status_code,
+                    status
+                )
+
+    def test_recipe_update_and_delete(self):
+        self.client.force_authenticate(self.author)
+        recipe = self.recipes[0]
+        response = self.client.patch(
+            f'/api/recipes/{recipe.id}/',
+            {
+                'tags': [self.tags[0].id],
+                'ingredients': [
+                    {'id': ingredient.id, 'amount': 5}
+                    for ingredient in self.ingredients[2:]
+                ],
+            },
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.client.delete(f'/api/recipes/{recipe.id}/').status_code, 204)
+
+    @override_settings(QUERY_BUDGETS={'recipe-list': 2})
+    def test_budget_exceeded(self):
+        with self.assertRaisesMessage(
+            QueryBudgetExceeded, 'recipe-list: 7 запросов к базе при бюджете 2'
+        ):
+            self.client.get('/api/recipes/')
+
+    def test_n_plus_one(self):
+        def get_response(request):
+            for recipe in self.recipes:
+                Recipe.objects.get(pk=recipe.pk)
+            return HttpResponse()
+
+        middleware = QueryBudgetMiddleware(get_response)
+        with self.assertRaisesMessage(
+            QueryBudgetExceeded, 'повторяющийся запрос (6 раз)'
+        ):
+            middleware(RequestFactory().get('/api/n-plus-one/'))
+
+    @override_settings(QUERY_BUDGET_ENABLED=False)
+    def test_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            QueryBudgetMiddleware(HttpResponse)
+
+
+class FeedTest(TestCase):
+    """Лента подписок: раскладка рецептов по лентам (fan-out), чтение
+    рецептов популярных авторов при запросе (pull) и их объединение."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader, cls.other_reader, cls.author, cls.popular = (
+            create_user(number) for number in range(1, 5))
+        cls.tag = Tag.objects.create(
+            name='Завтрак', color='#FF0000', slug='breakfast')
+        cls.recipes = [cls.publish(cls.author, days) for days in (5, 3, 1)]
+        cls.popular_recipes = [
+            cls.publish(cls.popular, days) for days in (4, 2)]
+        cls.recipes[1].tags.set((cls.tag,))
+        cls.popular_recipes[1].tags.set((cls.tag,))
+
+    @staticmethod
+    def publish(author, days):
+        recipe = create_recipe(author, ())
+        Recipe.objects.filter(pk=recipe.pk).update(
+            pub_date=timezone.now() - timedelta(days=days))
+        recipe.refresh_from_db()
+        return recipe
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+
+    def subscribe(self, user, author):
+        client = APIClient()
+        client.force_authenticate(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(f'/api/users/{author.id}/subscribe/')
+        self.assertEqual(response.status_code, 201)
+
+    def unsubscribe(self, user, author):
+        client = APIClient()
+        client.force_authenticate(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.delete(f'/api/users/{author.id}/subscribe/')
+        self.assertEqual(response.status_code, 204)
+
+    def get_feed(self, query=''):
+        response = self.client.get(f'/api/recipes/feed/{query}')
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def get_items(self, user):
+        return set(FeedItem.objects.filter(
+            user=user).values_list('recipe', flat=True))
+
+    def test_backfill_and_prune(self):
+        with override_settings(FEED_BACKFILL_SIZE=2):
+            self.subscribe(self.reader, self.author)
+        self.assertEqual(
+            self.get_items(self.reader),
+            {self.recipes[1].id, self.recipes[2].id}
+        )
+        self.unsubscribe(self.reader, self.author)
+        self.assertEqual(self.get_items(self.reader), set())
+        self.assertEqual(self.get_feed(), [])
+
+    def test_fan_out(self):
+        self.subscribe(self.reader, self.author)
+        self.subscribe(self.other_reader, self.author)
+        recipe = self.publish(self.author, 0)
+        FeedItem.fan_out(recipe)
+        for user in (self.reader, self.other_reader):
+            self.assertIn(recipe.id, self.get_items(user))
+        self.assertEqual(
+            self.get_feed(),
+            [recipe.id, *(recipe.id for recipe in self.recipes[::-1])]
+        )
+
+    @override_settings(FEED_FANOUT_MAX_SUBSCRIBERS=1)
+    def test_pull_author(self):
+        self.subscribe(self.reader, self.author)
+        self.subscribe(self.reader, self.popular)
+        self.subscribe(self.other_reader, self.popular)
+        recipe = self.publish(self.popular, 0)
+        FeedItem.fan_out(recipe)
+        self.assertEqual(
+            self.get_items(self.reader),
+            {recipe.id for recipe in self.recipes}
+            | {self.popular_recipes[0].id, self.popular_recipes[1].id}
+        )
+        # Рецепты, разложенные до того, как автор стал популярным,
+        # попадают в ленту один раз.
+        self.assertEqual(self.get_feed(), [
+            recipe.id,
+            self.recipes[2].id,
+            self.popular_recipes[1].id,
+            self.recipes[1].id,
+            self.popular_recipes[0].id,
+            self.recipes[0].id,
+        ])
+        self.assertEqual(
+            self.get_feed(f'?tags={self.tag.slug}'),
+            [self.popular_recipes[1].id, self.recipes[1].id]
+        )
+        self.assertEqual(self.get_feed('?limit=2&page=2'), [
+            self.popular_recipes[1].id, self.recipes[1].id])
+
+    @override_settings(FEED_FANOUT_MAX_SUBSCRIBERS=1)
+    def test_backfill_subscribers(self):
+        self.subscribe(self.reader, self.popular)
+        self.subscribe(self.other_reader, self.popular)
+        FeedItem.objects.all().delete()
+        recipe_ids = [recipe.id for recipe in self.popular_recipes[::-1]]
+        self.assertEqual(self.get_feed(), recipe_ids)
+        self.unsubscribe(self.other_reader, self.popular)
+        self.assertEqual(self.get_items(self.reader), set(recipe_ids))
+        self.assertEqual(self.get_feed(), recipe_ids)
+
+    def test_filtered(self):
+        self.subscribe(self.reader, self.author)
+        self.assertEqual(
+            self.get_feed(f'?tags={self.tag.slug}'), [self.recipes[1].id])
+        self.assertEqual(self.get_feed('?is_favorited=1'), [])
+
+
+class SubscriptionRecipesLimitTest(TestCase):
+    """Параметр recipes_limit в подписках: неверное значение дает 400."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader, cls.author = create_user(1), create_user(2)
+        for _ in range(3):
+            create_recipe(cls.author, ())
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+
+    def test_subscriptions(self):
+        Subscription.objects.create(user=self.reader, author=self.author)
+        for limit, count in (('2', 2), ('0', 0), ('', 3)):
+            response = self.client.get(
+                '/api/users/subscriptions/',
+                {'recipes_limit': limit} if limit else {}
+            )
+            self.assertEqual(response.status_code, 200)
+            [author] = response.data['results']
+            self.assertEqual(len(author['recipes']), count)
+            self.assertEqual(author['recipes_count'], 3)
+        for limit in ('abc', '-1', '1.5'):
+            response = self.client.get(
+                '/api/users/subscriptions/', {'recipes_limit': limit})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('recipes_limit', response.data)
+
+    def test_subscribe(self):
+        url = f'/api/users/{self.author.id}/subscribe/'
+        response = self.client.post(f'{url}?recipes_limit=-1')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Subscription.objects.exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'{url}?recipes_limit=1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['recipes']), 1)
@@ -1,37 +1,69 @@
+from functools import partial
+from urllib.parse import quote
+
 from django_filters.rest_framework import DjangoFilterBackend
-from django.http import FileResponse
-from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import (
+    Count,
+    Exists,
+    OuterRef,
+    Prefetch,
+    Subquery,
+)
+from django.http import Http404, StreamingHttpResponse
 from djoser.views import UserViewSet as DjoserUserViewSet
 from django.utils import timezone
-from rest_framework import mixins, status, viewsets
+from django.utils.cache import get_conditional_response
+from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
+from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import (
     IsAuthenticated,
     SAFE_METHODS
 )
 from rest_framework.response import Response
 
-from .filters import IngredientFilter, RecipeFilter
-from .functions import get_shopping_list_text
+from .conditional import (
+    conditional_response,
+    get_last_modified,
+    get_user_state,
+    make_etag,
+)
+from .filters import RecipeFilter, RecipeOrderingFilter
+from .functions import SHOPPING_LIST_EXPORTERS, get_shopping_list_etag
 from recipes.models import (
     Favorite,
+    FeedItem,
     Ingredient,
     Recipe,
+    ReferenceVersion,
     ShoppingList,
+    ShoppingListIngredient,
     Subscription,
     Tag,
     User,
 )
-from .pagination import LimitPageNumberPagination
+from .pagination import LimitPageNumberPagination, RecipePagination
 from .permissions import IsAuthorOrReadOnly
+from .reference import INGREDIENTS, TAGS
+from .renderers import SHOPPING_LIST_RENDERERS
+from .search import (
+    RECIPE_INGREDIENT_INDEX,
+    get_search_limit,
+    search_ingredients,
+)
 from .serializers import (
     IngredientSerializer,
     TagSerializer,
+    RecipeCoverageSerializer,
+    RecipeIdsSerializer,
     RecipeSerializer,
     RecipeWriteSerializer,
     ShortRecipeSerializer,
-    SubscriptionSerializer
+    ShoppingListSummarySerializer,
+    SubscriptionSerializer,
+    get_recipes_limit
 )
 
 
@@ -40,64 +72,246 @@ RECIPE_IN_SHOPPING_LIST_MESSAGE = {'errors': 'Рецепт уже в списк
 NO_RECIPE_IN_SHOPPING_LIST_MESSAGE = {
     'errors': 'Рецепта нет в списке покупок!'}
 SHOPPING_LIST_EMPTY_MESSAGE = {'errors': 'Список покупок пуст!'}
-SHOPPING_LIST_FILE_NAME = '{date}_{username}_shopping_list.txt'
+SHOPPING_LIST_FILE_NAME = '{date}_{username}_shopping_list.{format}'
 RECIPE_IN_FAVORITES_MESSAGE = {'errors': 'Рецепт уже в избранном!'}
 NO_RECIPE_IN_FAVORITE_MESSAGE = {'errors': 'Рецепта нет в избранном!'}
 SELF_SUBSCRIBE_MESSAGE = {'errors': 'Нельзя подписаться на себя!'}
 SUBSCRIPTION_EXIST_MESSAGE = {'errors': 'Вы уже подписаны на этого автора!'}
 NO_SUBSCRIBTION_MESSAGE = {'errors': 'Нельзя удалить несуществующую подписку!'}
+BULK_STATUSES = {
+    'POST': ('added', 'already_added'),
+    'DELETE': ('deleted', 'not_added'),
+}
+BULK_NOT_FOUND_STATUS = 'not_found'
+INGREDIENTS_QUERY_MESSAGE = {
+    'ingredients': 'Укажите id продуктов через запятую.'}
 
 
-class TagViewSet(
-    mixins.ListModelMixin,
-    mixins.RetrieveModelMixin,
-    viewsets.GenericViewSet
-):
-    queryset = Tag.objects.all()
+def annotate_is_subscribed(users, user):
+    if user.is_anonymous:
+        return users
+    return users.annotate(is_subscribed=Exists(Subscription.objects.filter(
+        user=user, author=OuterRef('pk'))))
+
+
+class ReferenceViewSet(viewsets.GenericViewSet):
+    """Справочник, который отдается из кэша в памяти процесса."""
     pagination_class = None
+    reference = None
+
+    def get_reference_items(self):
+        return self.reference.all()
+
+    def get_etag(self, request):
+        self.reference.refresh()
+        return make_etag(
+            self.reference.name,
+            self.reference.version,
+            request.get_full_path(),
+            request.accepted_renderer.format,
+        )
+
+    def list(self, request):
+        return conditional_response(
+            request,
+            lambda: Response(self.get_serializer(
+                self.get_reference_items(), many=True).data),
+            self.get_etag(request)
+        )
+
+    def retrieve(self, request, pk):
+        try:
+            item = self.reference.get(int(pk))
+        except ValueError:
+            item = None
+        if item is None:
+            raise Http404
+        return conditional_response(
+            request,
+            lambda: Response(self.get_serializer(item).data),
+            self.get_etag(request)
+        )
+
+
+class TagViewSet(ReferenceViewSet):
+    queryset = Tag.objects.all()
     serializer_class = TagSerializer
+    reference = TAGS
 
 
-class IngredientViewSet(
-    mixins.ListModelMixin,
-    mixins.RetrieveModelMixin,
-    viewsets.GenericViewSet
-):
+class IngredientViewSet(ReferenceViewSet):
     queryset = Ingredient.objects.all()
-    pagination_class = None
     serializer_class = IngredientSerializer
-    filter_backends = (DjangoFilterBackend,)
-    filterset_class = IngredientFilter
+    reference = INGREDIENTS
+
+    def get_reference_items(self):
+        name = self.request.query_params.get('name')
+        if not name:
+            return super().get_reference_items()
+        return search_ingredients(
+            name,
+            get_search_limit(self.request.query_params.get('limit'))
+        )
 
 
 class RecipeViewSet(viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
-    pagination_class = LimitPageNumberPagination
-    filter_backends = (DjangoFilterBackend,)
+    pagination_class = RecipePagination
+    filter_backends = (DjangoFilterBackend, RecipeOrderingFilter)
     permission_classes = (IsAuthorOrReadOnly,)
     filterset_class = RecipeFilter
+    ordering_fields = ('pub_date', 'favorites_count', 'in_carts_count')
+    ordering = ('-pub_date', 'id')
+
+    def get_queryset(self):
+        user = self.request.user
+        recipes = super().get_queryset().prefetch_related(
+            Prefetch(
+                'author',
+                queryset=annotate_is_subscribed(User.objects.all(), user)
+            ),
+            Prefetch('tags', queryset=Tag.objects.only('id')),
+            'recipeingredients',
+        )
+        if user.is_anonymous:
+            return recipes
+        return recipes.annotate(
+            is_favorited=Exists(Favorite.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            is_in_shopping_cart=Exists(ShoppingList.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+        )
+
+    def get_etag(self, request, *parts):
+        TAGS.refresh()
+        INGREDIENTS.refresh()
+        return make_etag(
+            *parts,
+            TAGS.version,
+            INGREDIENTS.version,
+            get_user_state(request.user),
+            request.get_full_path(),
+            request.accepted_renderer.format,
+        )
+
+    def list(self, request, *args, **kwargs):
+        # Версия рецептов меняется при любом изменении, видном в списках
+        # (см. api.signals), поэтому рецепты для валидаторов не читаются.
+        states = ReferenceVersion.get_states(
+            ReferenceVersion.RECIPES,
+            ReferenceVersion.TAGS,
+            ReferenceVersion.INGREDIENTS,
+        )
+        return conditional_response(
+            request,
+            partial(super().list, request, *args, **kwargs),
+            self.get_etag(request, states[ReferenceVersion.RECIPES][0]),
+            get_last_modified(*(
+                updated_at for _, updated_at in states.values()
+            )) if request.user.is_anonymous else None
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        state = get_object_or_404(
+            self.get_queryset().values_list(
+                'updated_at', 'author__updated_at'),
+            pk=kwargs['pk']
+        )
+        return conditional_response(
+            request,
+            partial(super().retrieve, request, *args, **kwargs),
+            self.get_etag(request, kwargs['pk'], *state),
+            get_last_modified(*state)
+            if request.user.is_anonymous else None
+        )
 
     @staticmethod
-    def add_delete_obj(request, pk, model, message):
+    def lock_user(user):
+        """Блокирует строку пользователя до конца транзакции: одиночные и
+        пакетные запросы к его избранному и списку покупок выполняются
+        по очереди и не посчитают один рецепт дважды в счетчиках и
+        списке покупок."""
+        list(User.objects.select_for_update().filter(
+            pk=user.pk).values_list('pk'))
+
+    @classmethod
+    @transaction.atomic
+    def add_delete_obj(cls, request, pk, model, message):
         user = request.user
+        cls.lock_user(user)
         recipe = get_object_or_404(Recipe, id=pk)
         if request.method == 'POST':
             _, created = model.objects.get_or_create(
                 user=user, recipe=recipe)
             if not created:
                 raise ValidationError(message)
+            Recipe.update_counter((recipe.id,), model.COUNTER_FIELD, 1)
+            if model is ShoppingList:
+                ShoppingListIngredient.update_amounts(
+                    (user.id,),
+                    ShoppingListIngredient.get_recipe_amounts(recipe)
+                )
             serializer = ShortRecipeSerializer(recipe)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         get_object_or_404(model, user=user, recipe=recipe).delete()
+        Recipe.update_counter((recipe.id,), model.COUNTER_FIELD, -1)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @classmethod
+    @transaction.atomic
+    def bulk_add_delete_objs(cls, request, model):
+        serializer = RecipeIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        recipe_ids = serializer.validated_data['recipes']
+        user = request.user
+        cls.lock_user(user)
+        found = set(Recipe.objects.filter(
+            pk__in=recipe_ids).values_list('pk', flat=True))
+        present = set(model.objects.filter(
+            user=user, recipe_id__in=found
+        ).values_list('recipe_id', flat=True))
+        if request.method == 'POST':
+            changed = [
+                pk for pk in recipe_ids if pk in found and pk not in present]
+            model.objects.bulk_create(
+                (model(user=user, recipe_id=pk) for pk in changed),
+                ignore_conflicts=True
+            )
+            sign = 1
+        else:
+            changed = [pk for pk in recipe_ids if pk in present]
+            model.objects.filter(user=user, recipe_id__in=changed).delete()
+            sign = -1
+        if changed:
+            Recipe.update_counter(changed, model.COUNTER_FIELD, sign)
+            # Удаленные из списка покупок рецепты вычитает сигнал.
+            if model is ShoppingList and sign > 0:
+                amounts, recipe_counts = (
+                    ShoppingListIngredient.get_recipes_amounts(changed))
+                ShoppingListIngredient.update_amounts(
+                    (user.id,), amounts, sign, recipe_counts)
+        changed_status, unchanged_status = BULK_STATUSES[request.method]
+        changed = set(changed)
+        return Response({'results': [
+            {
+                'id': pk,
+                'status': (
+                    BULK_NOT_FOUND_STATUS if pk not in found
+                    else changed_status if pk in changed
+                    else unchanged_status
+                ),
+            }
+            for pk in recipe_ids
+        ]})
+
     def get_serializer_class(self):
         if self.request.method in SAFE_METHODS:
             return RecipeSerializer
         return RecipeWriteSerializer
 
+    @transaction.atomic
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        FeedItem.fan_out(serializer.save(author=self.request.user))
 
     @action(methods=('POST', 'DELETE'),
             detail=True,
@@ -114,20 +328,53 @@ class RecipeViewSet(viewsets.ModelViewSet):
     @action(methods=('GET',),
             detail=False,
             url_path='download_shopping_cart',
-            permission_classes=(IsAuthenticated,))
+            permission_classes=(IsAuthenticated,),
+            renderer_classes=SHOPPING_LIST_RENDERERS)
     def download_shopping_list(self, request):
         user = request.user
         if not ShoppingList.objects.filter(user=user).exists():
             raise ValidationError(SHOPPING_LIST_EMPTY_MESSAGE)
+        renderer = request.accepted_renderer
+        etag = get_shopping_list_etag(user, renderer.format)
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
         filename = SHOPPING_LIST_FILE_NAME.format(
             date=timezone.now().strftime("%d-%m-%Y"),
-            username=user.username
+            username=user.username,
+            format=renderer.format
+        )
+        response = StreamingHttpResponse(
+            (
+                chunk.encode() if isinstance(chunk, str) else chunk
+                for chunk in SHOPPING_LIST_EXPORTERS[renderer.format](user)
+            ),
+            content_type=(
+                renderer.media_type
+                if renderer.charset is None
+                else f'{renderer.media_type}; charset={renderer.charset}'
+            )
         )
-        return FileResponse(
-            get_shopping_list_text(user),
-            content_type='text/plain',
-            filename=filename
+        response['Content-Disposition'] = (
+            f"attachment; filename*=utf-8''{quote(filename)}")
+        response['ETag'] = etag
+        return response
+
+    @action(methods=('GET',),
+            detail=False,
+            url_path='shopping_cart/summary',
+            permission_classes=(IsAuthenticated,))
+    def shopping_list_summary(self, request):
+        user = request.user
+        serializer = ShoppingListSummarySerializer(
+            {
+                'recipes': ShoppingList.get_shopping_list_recipes(user),
+                'ingredients': ShoppingList.get_shopping_list_ingredients(
+                    user),
+            },
+            context=self.get_serializer_context()
         )
+        return Response(serializer.data)
 
     @action(methods=('POST', 'DELETE'),
             detail=True,
@@ -141,8 +388,109 @@ class RecipeViewSet(viewsets.ModelViewSet):
             RECIPE_IN_FAVORITES_MESSAGE
         )
 
+    @action(methods=('POST', 'DELETE'),
+            detail=False,
+            url_path='shopping_cart',
+            permission_classes=(IsAuthenticated,))
+    def bulk_shopping_cart(self, request):
+        return RecipeViewSet.bulk_add_delete_objs(request, ShoppingList)
+
+    @action(methods=('POST', 'DELETE'),
+            detail=False,
+            url_path='favorite',
+            permission_classes=(IsAuthenticated,))
+    def bulk_favorites(self, request):
+        return RecipeViewSet.bulk_add_delete_objs(request, Favorite)
+
+    @action(methods=('GET',),
+            detail=False,
+            url_path='feed',
+            permission_classes=(IsAuthenticated,),
+            filter_backends=(DjangoFilterBackend,),
+            pagination_class=LimitPageNumberPagination)
+    def feed(self, request):
+        recipes = self.get_queryset()
+        filtered = self.filter_queryset(recipes)
+        page = self.paginate_queryset(FeedItem.get_feed(
+            request.user, filtered if filtered.query.has_filters() else None
+        ))
+        recipes = recipes.in_bulk([recipe_id for recipe_id, _ in page])
+        serializer = RecipeSerializer(
+            [
+                recipes[recipe_id] for recipe_id, _ in page
+                if recipe_id in recipes
+            ],
+            many=True,
+            context=self.get_serializer_context()
+        )
+        return self.get_paginated_response(serializer.data)
+
+    @action(methods=('GET',),
+            detail=True,
+            url_path='similar')
+    def similar(self, request, pk):
+        recipe = get_object_or_404(Recipe.objects.only('id'), pk=pk)
+        recipes = Recipe.objects.filter(
+            similar_to__recipe=recipe
+        ).order_by('-similar_to__score', 'id')
+        serializer = ShortRecipeSerializer(
+            recipes, many=True, context=self.get_serializer_context())
+        return Response(serializer.data)
+
+    @action(methods=('GET',),
+            detail=False,
+            url_path='by_ingredients',
+            filter_backends=(),
+            pagination_class=LimitPageNumberPagination)
+    def by_ingredients(self, request):
+        try:
+            ingredient_ids = [
+                int(pk)
+                for value in request.query_params.getlist('ingredients')
+                for pk in value.split(',') if pk
+            ]
+        except ValueError:
+            raise ValidationError(INGREDIENTS_QUERY_MESSAGE)
+        if not ingredient_ids:
+            raise ValidationError(INGREDIENTS_QUERY_MESSAGE)
+        page = self.paginate_queryset(
+            RECIPE_INGREDIENT_INDEX.search(ingredient_ids))
+        recipes = self.get_queryset().in_bulk(
+            [recipe_id for recipe_id, _, _ in page])
+        for recipe_id, coverage, matched in page:
+            if recipe_id in recipes:
+                recipes[recipe_id].coverage = coverage
+                recipes[recipe_id].matched_ingredients = matched
+        serializer = RecipeCoverageSerializer(
+            [
+                recipes[recipe_id] for recipe_id, _, _ in page
+                if recipe_id in recipes
+            ],
+            many=True,
+            context=self.get_serializer_context()
+        )
+        return self.get_paginated_response(serializer.data)
+
+    @action(methods=('GET',),
+            detail=False,
+            url_path='trending',
+            filter_backends=(DjangoFilterBackend,),
+            pagination_class=LimitPageNumberPagination)
+    def trending(self, request):
+        recipes = self.filter_queryset(self.get_queryset()).filter(
+            trending_score__isnull=False
+        ).order_by('-trending_score__score', 'id')
+        page = self.paginate_queryset(recipes)
+        serializer = RecipeSerializer(
+            page, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
+
 
 class UserViewSet(DjoserUserViewSet):
+    def get_queryset(self):
+        return annotate_is_subscribed(
+            super().get_queryset(), self.request.user)
+
     def get_permissions(self):
         if self.request.path == '/api/users/me/':
             return (IsAuthenticated(),)
@@ -152,22 +500,26 @@ class UserViewSet(DjoserUserViewSet):
             detail=True,
             url_path='subscribe',
             permission_classes=(IsAuthenticated,))
+    @transaction.atomic
     def subscribtion(self, request, id):
         user = request.user
         author = get_object_or_404(User, id=id)
         if user == author:
             raise ValidationError(SELF_SUBSCRIBE_MESSAGE)
         if request.method == 'POST':
+            get_recipes_limit(request)
             _, created = Subscription.objects.get_or_create(
                 user=user, author=author)
             if not created:
                 raise ValidationError(SUBSCRIPTION_EXIST_MESSAGE)
+            FeedItem.backfill(user, author)
             serializer = SubscriptionSerializer(
                 author, context=self.get_serializer_context())
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         subscribtion = get_object_or_404(
             Subscription, user=user, author=author)
         subscribtion.delete()
+        FeedItem.prune(user, author)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(methods=('GET',),
@@ -175,8 +527,23 @@ class UserViewSet(DjoserUserViewSet):
             url_path='subscriptions',
             permission_classes=(IsAuthenticated,))
     def get_subscribtions(self, request):
+        recipes = Recipe.objects.all()
+        recipes_limit = get_recipes_limit(request)
+        if recipes_limit is not None:
+            recipes = recipes.filter(pk__in=Subquery(
+                Recipe.objects.filter(
+                    author=OuterRef('author')
+                ).values('pk')[:recipes_limit]
+            ))
         pages = self.paginate_queryset(
-            User.objects.filter(subscriptions__user=request.user))
+            User.objects.filter(
+                subscriptions__user=request.user
+            ).annotate(
+                recipes_count=Count('recipes')
+            ).order_by('username').prefetch_related(Prefetch(
+                'recipes', queryset=recipes, to_attr='preview_recipes'
+            ))
+        )
         serializer = SubscriptionSerializer(
             pages, many=True, context=self.get_serializer_context())
         return self.get_paginated_response(serializer.data)
@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -172,3 +173,60 @@ DJOSER = {
 }
 
 FOLDER_FOR_IMPORT = os.path.join(BASE_DIR, 'data')
+
+SHOPPING_LIST_PDF_FONT = os.getenv('SHOPPING_LIST_PDF_FONT', 'DejaVuSans.ttf')
+
+INGREDIENT_SEARCH_LIMIT = int(os.getenv('INGREDIENT_SEARCH_LIMIT', 50))
+
+REFERENCE_CACHE_TIMEOUT = int(os.getenv('REFERENCE_CACHE_TIMEOUT', 5))
+
+IMAGE_PIPELINE_SYNC = os.getenv('IMAGE_PIPELINE_SYNC', 'False') == 'True'
+IMAGE_PIPELINE_WORKERS = int(os.getenv('IMAGE_PIPELINE_WORKERS', 2))
+IMAGE_VARIANT_FORMAT = os.getenv('IMAGE_VARIANT_FORMAT', 'WEBP')
+
+RECIPE_IMAGE_MAX_SIZE = int(os.getenv('RECIPE_IMAGE_MAX_SIZE', 10 * 1024 * 1024))
+
+TRENDING_HALF_LIFE_HOURS = float(os.getenv('TRENDING_HALF_LIFE_HOURS', 24))
+
+FEED_FANOUT_MAX_SUBSCRIBERS = int(
+    os.getenv('FEED_FANOUT_MAX_SUBSCRIBERS', 1000))
+FEED_BACKFILL_SIZE = int(os.getenv('FEED_BACKFILL_SIZE', 100))
+
+QUERY_BUDGET_ENABLED = (
+    os.getenv('QUERY_BUDGET_ENABLED', str(DEBUG)) == 'True')
+QUERY_BUDGET_STRICT = os.getenv('QUERY_BUDGET_STRICT', 'False') == 'True'
+QUERY_BUDGET_PATH_PREFIX = '/api/'
+QUERY_BUDGET_DEFAULT = int(os.getenv('QUERY_BUDGET_DEFAULT', 20))
+QUERY_N_PLUS_ONE_THRESHOLD = int(os.getenv('QUERY_N_PLUS_ONE_THRESHOLD', 5))
+QUERY_BUDGETS = {
+    'tag-list': 3,
+    'tag-detail': 3,
+    'ingredient-list': 3,
+    'ingredient-detail': 3,
+    'recipe-list': 10,
+    'recipe-list:POST': 20,
+    'recipe-detail': 10,
+    'recipe-detail:PATCH': 35,
+    'recipe-detail:DELETE': 25,
+    'recipe-feed': 10,
+    'recipe-trending': 10,
+    'recipe-by-ingredients': 10,
+    'recipe-similar': 3,
+    'recipe-bulk-favorites': 10,
+    'recipe-bulk-shopping-cart': 15,
+    'user-get-subscribtions': 6,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'api.middleware': {
+            'handlers': ['console'],
+            'level': os.getenv('QUERY_BUDGET_LOG_LEVEL', 'WARNING'),
+        },
+    },
+}
@@ -12,6 +12,7 @@ from .models import (
     Recipe,
     RecipeIngredient,
     ShoppingList,
+    ShoppingListIngredient,
     Subscription,
     Tag,
     User,
@@ -137,13 +138,14 @@ class RecipeAdmin(admin.ModelAdmin):
         'show_tags',
         'show_ingredients',
         'added_to_favorites',
+        'in_carts_count',
         'image_preview',
         'pub_date',
     )
     list_filter = (('author', admin.filters.RelatedOnlyFieldListFilter),
                    ('tags', admin.filters.RelatedOnlyFieldListFilter),
                    RecipesCookingTimeFilter)
-    readonly_fields = ('added_to_favorites', 'show_tags',
+    readonly_fields = ('added_to_favorites', 'in_carts_count', 'show_tags',
                        'show_ingredients', 'image_preview')
     inlines = (RecipeIngredientInLine, )
     search_fields = ('name', 'author__username', 'tags__name', 'tags__slug')
@@ -151,11 +153,14 @@ class RecipeAdmin(admin.ModelAdmin):
     @display(description='Изображение')
     @mark_safe
     def image_preview(self, recipe):
+        thumb = recipe.image_variants.get('thumb')
+        if thumb:
+            return f'<img src="{recipe.image.storage.url(thumb)}" />'
         return f'<img src="{recipe.image.url}" width="150" height="150" />'
 
-    @display(description='В избранном у')
+    @display(description='В избранном у', ordering='favorites_count')
     def added_to_favorites(self, recipe):
-        return recipe.favorites.count()
+        return recipe.favorites_count
 
     @display(description='Тэги')
     @mark_safe
@@ -218,3 +223,11 @@ class RecipeIngredientAdmin(admin.ModelAdmin):
     @display(description='Название рецепта')
     def recipe_name(self, recipeingredient):
         return recipeingredient.recipe.name
+
+
+@admin.register(ShoppingListIngredient)
+class ShoppingListIngredientAdmin(admin.ModelAdmin):
+    list_display = ('user', 'ingredient', 'total_amount', 'recipe_count',)
+    list_select_related = ('user', 'ingredient',)
+    search_fields = ('user__username', 'ingredient__name',)
+    readonly_fields = ('user', 'ingredient', 'total_amount', 'recipe_count',)
@@ -0,0 +1,102 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps, features
+
+from .models import Recipe
+
+
+IMAGE_VARIANTS = (
+    ('thumb', 150),
+    ('card', 480),
+    ('full', 1280),
+)
+VARIANTS_FOLDER = 'recipes/variants/'
+
+logger = logging.getLogger(__name__)
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_PIPELINE_WORKERS,
+            thread_name_prefix='image-pipeline'
+        )
+    return _executor
+
+
+def get_variant_format():
+    if settings.IMAGE_VARIANT_FORMAT == 'WEBP' and features.check('webp'):
+        return 'WEBP', 'webp'
+    return 'JPEG', 'jpg'
+
+
+def render_variants(image_file):
+    """Уменьшенные копии изображения: {вариант: байты}."""
+    image_format, _ = get_variant_format()
+    with Image.open(image_file) as image:
+        image = ImageOps.exif_transpose(image)
+        if image_format == 'JPEG' or image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+        variants = {}
+        for name, size in IMAGE_VARIANTS:
+            variant = image.copy()
+            variant.thumbnail((size, size))
+            buffer = BytesIO()
+            variant.save(buffer, image_format, quality=80)
+            variants[name] = buffer.getvalue()
+    return variants
+
+
+def build_image_variants(recipe_id):
+    recipe = Recipe.objects.filter(pk=recipe_id).only(
+        'image', 'image_variants').first()
+    if recipe is None or not recipe.image:
+        return None
+    storage = recipe.image.storage
+    _, extension = get_variant_format()
+    with recipe.image.open('rb') as image_file:
+        rendered = render_variants(image_file)
+    variants = {'source': recipe.image.name}
+    for name, content in rendered.items():
+        variants[name] = storage.save(
+            f'{VARIANTS_FOLDER}{name}.{extension}',
+            ContentFile(content)
+        )
+    if not Recipe.objects.filter(
+        pk=recipe_id, image=recipe.image.name
+    ).update(image_variants=variants, updated_at=timezone.now()):
+        return None
+    return variants
+
+
+def run_image_variants(recipe_id):
+    try:
+        build_image_variants(recipe_id)
+    except Exception:
+        logger.exception(
+            'Не удалось подготовить изображения рецепта %s', recipe_id)
+    finally:
+        connections.close_all()
+
+
+def schedule_image_variants(recipe):
+    """Готовит уменьшенные копии изображения рецепта.
+
+    В фоновом потоке после фиксации транзакции, а при
+    IMAGE_PIPELINE_SYNC — сразу в текущем потоке (для тестов).
+    """
+    if settings.IMAGE_PIPELINE_SYNC:
+        variants = build_image_variants(recipe.pk)
+        if variants is not None:
+            recipe.image_variants = variants
+        return
+    transaction.on_commit(
+        lambda: get_executor().submit(run_image_variants, recipe.pk))
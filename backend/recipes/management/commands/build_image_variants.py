@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from ...images import build_image_variants
+from ...models import Recipe
+
+
+class Command(BaseCommand):
+    help = 'Подготовка уменьшенных изображений рецептов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Пересоздать изображения и для рецептов, где они уже есть',
+        )
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.exclude(image='')
+        if not options['all']:
+            recipes = recipes.filter(image_variants={})
+        built = 0
+        for recipe_id in recipes.values_list('pk', flat=True).iterator():
+            if build_image_variants(recipe_id) is not None:
+                built += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Подготовлены изображения для {built} рецептов'))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from ...similarity import build_similar_recipes
+
+
+class Command(BaseCommand):
+    help = ('Расчет похожих рецептов. Без --full пересчитывает только '
+            'рецепты, измененные после прошлого запуска')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Пересчитать похожие рецепты для всех рецептов',
+        )
+
+    def handle(self, *args, **options):
+        count = build_similar_recipes(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитаны похожие рецепты для {count} рецептов'))
@@ -0,0 +1,80 @@
+import posixpath
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from ...images import VARIANTS_FOLDER
+from ...models import Recipe
+
+
+RECIPE_IMAGES_FOLDER = Recipe._meta.get_field('image').upload_to
+
+
+class Command(BaseCommand):
+    help = 'Удаление изображений, на которые не ссылается ни один рецепт'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать файлы, которые будут удалены',
+        )
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=60,
+            help='Не трогать файлы моложе указанного числа минут',
+        )
+
+    def get_referenced_names(self):
+        names = set()
+        for image, variants in Recipe.objects.values_list(
+            'image', 'image_variants'
+        ).iterator(chunk_size=2000):
+            names.add(image)
+            names.update(variants.values())
+        return names
+
+    def is_referenced(self, name):
+        return Recipe.objects.filter(
+            Q(image=name) | Q(image_variants__icontains=name)).exists()
+
+    def walk(self, storage, directory):
+        directories, files = storage.listdir(directory)
+        for name in files:
+            yield posixpath.join(directory, name)
+        for name in directories:
+            yield from self.walk(storage, posixpath.join(directory, name))
+
+    def handle(self, *args, **options):
+        storage = Recipe._meta.get_field('image').storage
+        referenced = self.get_referenced_names()
+        created_before = timezone.now() - timedelta(
+            minutes=options['min_age'])
+        removed = 0
+        for folder in (RECIPE_IMAGES_FOLDER, VARIANTS_FOLDER):
+            if not storage.exists(folder):
+                continue
+            for name in self.walk(storage, folder.rstrip('/')):
+                if (
+                    name in referenced
+                    or storage.get_modified_time(name) > created_before
+                ):
+                    continue
+                # Файл могли загрузить повторно после чтения ссылок:
+                # загрузка обновляет время изменения существующего файла.
+                if (
+                    self.is_referenced(name)
+                    or storage.get_modified_time(name) > created_before
+                ):
+                    continue
+                if options['dry_run']:
+                    self.stdout.write(name)
+                else:
+                    storage.delete(name)
+                removed += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Неиспользуемых файлов: {removed}'
+            + (' (не удалены)' if options['dry_run'] else '')))
@@ -3,7 +3,7 @@ import json
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from ...models import Ingredient
+from ...models import Ingredient, ReferenceVersion
 
 
 class Command(BaseCommand):
@@ -21,6 +21,7 @@ class Command(BaseCommand):
             (Ingredient(**ingredient) for ingredient in ingredients),
             ignore_conflicts=True
         )
+        ReferenceVersion.bump(ReferenceVersion.INGREDIENTS)
         self.stdout.write(self.style.SUCCESS(
             'Импортировано '
             f'{Ingredient.objects.count()-ingrediens_amount_before} '
@@ -3,7 +3,7 @@ import json
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from ...models import Tag
+from ...models import ReferenceVersion, Tag
 
 
 class Command(BaseCommand):
@@ -21,5 +21,6 @@ class Command(BaseCommand):
             (Tag(**tag) for tag in tags),
             ignore_conflicts=True
         )
+        ReferenceVersion.bump(ReferenceVersion.TAGS)
         self.stdout.write(self.style.SUCCESS(
             f'Импортировано {Tag.objects.count()-tags_amount_before} тэгов'))
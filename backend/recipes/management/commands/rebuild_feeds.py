@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import FeedItem, Subscription
+
+
+class Command(BaseCommand):
+    help = 'Заполнение лент подписок по существующим подпискам'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            FeedItem.objects.all().delete()
+            subscriptions = Subscription.objects.select_related(
+                'user', 'author')
+            for subscription in subscriptions.iterator():
+                FeedItem.backfill(subscription.user, subscription.author)
+        self.stdout.write(self.style.SUCCESS(
+            f'Записей в лентах: {FeedItem.objects.count()}'))
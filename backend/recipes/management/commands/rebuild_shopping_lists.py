@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...models import ShoppingListIngredient
+
+
+class Command(BaseCommand):
+    help = 'Пересчет суммарных продуктов в списках покупок'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только сверить сохраненные суммы с рецептами',
+        )
+
+    def handle(self, *args, **options):
+        live_rows = {
+            (user, ingredient): (total_amount, recipe_count)
+            for user, ingredient, total_amount, recipe_count
+            in ShoppingListIngredient.get_live_amounts().iterator()
+        }
+        stored_rows = {
+            (user, ingredient): (total_amount, recipe_count)
+            for user, ingredient, total_amount, recipe_count
+            in ShoppingListIngredient.objects.values_list(
+                'user', 'ingredient', 'total_amount', 'recipe_count'
+            ).iterator()
+        }
+        mismatches = sum(
+            1 for key in live_rows.keys() | stored_rows.keys()
+            if live_rows.get(key) != stored_rows.get(key)
+        )
+        if options['check']:
+            if mismatches:
+                raise CommandError(
+                    f'Расхождений в списках покупок: {mismatches}')
+            self.stdout.write(self.style.SUCCESS(
+                'Списки покупок совпадают с рецептами'))
+            return
+        with transaction.atomic():
+            ShoppingListIngredient.objects.all().delete()
+            ShoppingListIngredient.objects.bulk_create(
+                (
+                    ShoppingListIngredient(
+                        user_id=user,
+                        ingredient_id=ingredient,
+                        total_amount=total_amount,
+                        recipe_count=recipe_count,
+                    )
+                    for (user, ingredient), (total_amount, recipe_count)
+                    in live_rows.items()
+                ),
+                batch_size=1000
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитано {len(live_rows)} строк, '
+            f'исправлено расхождений: {mismatches}'))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, Q
+
+from ...models import Recipe, ReferenceVersion
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Сверка счетчиков избранного и списков покупок у рецептов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только сверить счетчики без исправления',
+        )
+
+    def handle(self, *args, **options):
+        mismatched = Recipe.get_live_counters().filter(
+            ~Q(favorites_count=F('live_favorites_count'))
+            | ~Q(in_carts_count=F('live_in_carts_count'))
+        ).only('id', 'favorites_count', 'in_carts_count')
+        if options['check']:
+            mismatches = mismatched.count()
+            if mismatches:
+                raise CommandError(
+                    f'Расхождений в счетчиках рецептов: {mismatches}')
+            self.stdout.write(self.style.SUCCESS(
+                'Счетчики рецептов совпадают'))
+            return
+        with transaction.atomic():
+            recipes = list(mismatched.select_for_update(of=('self',)))
+            for recipe in recipes:
+                recipe.favorites_count = recipe.live_favorites_count
+                recipe.in_carts_count = recipe.live_in_carts_count
+            Recipe.objects.bulk_update(
+                recipes,
+                ('favorites_count', 'in_carts_count'),
+                batch_size=BATCH_SIZE
+            )
+            if recipes:
+                ReferenceVersion.bump(ReferenceVersion.RECIPES)
+        self.stdout.write(self.style.SUCCESS(
+            f'Исправлено счетчиков рецептов: {len(recipes)}'))
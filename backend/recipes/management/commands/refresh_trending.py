@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from ...trending import refresh_trending_scores
+
+
+class Command(BaseCommand):
+    help = ('Пересчет рейтинга популярных рецептов. '
+            'Рассчитан на запуск по расписанию (cron)')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Построить рейтинг заново, а не дополнить прошлый',
+        )
+
+    def handle(self, *args, **options):
+        count = refresh_trending_scores(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Рейтинг популярности пересчитан, рецептов: {count}'))
@@ -0,0 +1,57 @@
+# Generated by Django 3.2.16 on 2026-10-18 04:26
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+import django.db.models.deletion
+
+
+def fill_shopping_list_ingredients(apps, schema_editor):
+    RecipeIngredient = apps.get_model('recipes', 'RecipeIngredient')
+    ShoppingListIngredient = apps.get_model(
+        'recipes', 'ShoppingListIngredient')
+    ShoppingListIngredient.objects.bulk_create(
+        ShoppingListIngredient(
+            user_id=row['recipe__shoppinglists__user'],
+            ingredient_id=row['ingredient'],
+            total_amount=row['total_amount'],
+            recipe_count=row['recipe_count'],
+        )
+        for row in RecipeIngredient.objects.filter(
+            recipe__shoppinglists__isnull=False
+        ).values(
+            'recipe__shoppinglists__user', 'ingredient'
+        ).annotate(
+            total_amount=Sum('amount'), recipe_count=Count('recipe')
+        ).order_by()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_auto_20231227_2241'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingListIngredient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_amount', models.PositiveIntegerField(verbose_name='Мера')),
+                ('recipe_count', models.PositiveIntegerField(verbose_name='Рецептов')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shoppinglistingredients', to='recipes.ingredient', verbose_name='Продукт')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shoppinglistingredients', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Продукт в списке покупок',
+                'verbose_name_plural': 'Продукты в списках покупок',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='shoppinglistingredient',
+            constraint=models.UniqueConstraint(fields=('user', 'ingredient'), name='unique_shopping_list_ingredient'),
+        ),
+        migrations.RunPython(
+            fill_shopping_list_ingredients, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations
+
+
+CREATE_INDEXES = (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ingredient_name_upper_like_idx '
+    'ON recipes_ingredient (UPPER(name::text) text_pattern_ops)',
+    'CREATE INDEX IF NOT EXISTS ingredient_name_upper_trgm_idx '
+    'ON recipes_ingredient USING gin (UPPER(name::text) gin_trgm_ops)',
+)
+DROP_INDEXES = (
+    'DROP INDEX IF EXISTS ingredient_name_upper_like_idx',
+    'DROP INDEX IF EXISTS ingredient_name_upper_trgm_idx',
+)
+
+
+def execute_on_postgresql(statements):
+    def execute(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return execute
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0012_recipeingredient_recipe_ingredient_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            execute_on_postgresql(CREATE_INDEXES),
+            execute_on_postgresql(DROP_INDEXES),
+        ),
+    ]
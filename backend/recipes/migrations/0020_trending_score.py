@@ -0,0 +1,54 @@
+# Generated by Django 3.2.16 on 2026-10-18 04:39
+
+from datetime import datetime, timezone
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+# Избранное и покупки, добавленные до появления added_at, получают
+# заведомо старую дату, чтобы не попасть в рейтинг как новые события.
+HISTORIC_ADDED_AT = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def fill_historic_added_at(apps, schema_editor):
+    for model_name in ('Favorite', 'ShoppingList'):
+        apps.get_model('recipes', model_name).objects.update(
+            added_at=HISTORIC_ADDED_AT)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0019_recipe_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrendingScore',
+            fields=[
+                ('recipe', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='trending_score', serialize=False, to='recipes.recipe', verbose_name='Рецепт')),
+                ('score', models.FloatField(default=0, verbose_name='Рейтинг')),
+                ('refreshed_at', models.DateTimeField(verbose_name='Дата пересчета')),
+            ],
+            options={
+                'verbose_name': 'Рейтинг популярности',
+                'verbose_name_plural': 'Рейтинги популярности',
+            },
+        ),
+        migrations.AddField(
+            model_name='favorite',
+            name='added_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Дата добавления'),
+        ),
+        migrations.AddField(
+            model_name='shoppinglist',
+            name='added_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Дата добавления'),
+        ),
+        migrations.RunPython(fill_historic_added_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='trendingscore',
+            index=models.Index(fields=['-score'], name='trending_score_idx'),
+        ),
+    ]
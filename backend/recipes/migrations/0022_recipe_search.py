@@ -0,0 +1,52 @@
+from django.db import migrations
+
+
+CREATE_SEARCH = {
+    'postgresql': (
+        "ALTER TABLE recipes_recipe ADD COLUMN IF NOT EXISTS search_vector "
+        "tsvector GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('russian', coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('russian', coalesce(text, '')), 'B')"
+        ") STORED",
+        'CREATE INDEX IF NOT EXISTS recipe_search_vector_idx '
+        'ON recipes_recipe USING gin (search_vector)',
+    ),
+    'sqlite': (
+        'CREATE VIRTUAL TABLE IF NOT EXISTS recipes_recipe_fts USING fts5('
+        "name, text, tokenize = 'unicode61 remove_diacritics 2')",
+        'INSERT INTO recipes_recipe_fts (rowid, name, text) '
+        'SELECT id, name, text FROM recipes_recipe',
+    ),
+}
+DROP_SEARCH = {
+    'postgresql': (
+        'DROP INDEX IF EXISTS recipe_search_vector_idx',
+        'ALTER TABLE recipes_recipe DROP COLUMN IF EXISTS search_vector',
+    ),
+    'sqlite': (
+        'DROP TABLE IF EXISTS recipes_recipe_fts',
+    ),
+}
+
+
+def execute_for_vendor(statements):
+    def execute(apps, schema_editor):
+        for statement in statements.get(
+            schema_editor.connection.vendor, ()
+        ):
+            schema_editor.execute(statement)
+    return execute
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0021_feeditem'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            execute_for_vendor(CREATE_SEARCH),
+            execute_for_vendor(DROP_SEARCH),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.16 on 2026-10-18 05:07
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_content_updated_at(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Recipe.objects.update(content_updated_at=F('updated_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0024_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='content_updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='Дата изменения содержания'),
+        ),
+        migrations.RunPython(fill_content_updated_at, migrations.RunPython.noop),
+    ]
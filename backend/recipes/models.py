@@ -1,9 +1,13 @@
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Sum
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, Greatest
 from django.core.validators import MinValueValidator, RegexValidator
+from django.utils import timezone
 
+from .storage import ContentAddressedStorage
 from .validators import validate_username
 
 
@@ -26,6 +30,20 @@ RECIPE = (
 )
 SELF_SUBSCRIBE_MESSAGE = 'Нельзя подписаться на себя!'
 INVALID_COLOR_MESSAGE = 'Задайте цвет в HEX формате!'
+FEED_BATCH_SIZE = 1000
+CONFLICT_ATTEMPTS = 3
+
+
+def retry_on_conflict(function, *args):
+    """Выполняет function в точке сохранения и повторяет ее, если
+    параллельная транзакция успела вставить те же уникальные строки."""
+    for attempt in range(CONFLICT_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                return function(*args)
+        except IntegrityError:
+            if attempt == CONFLICT_ATTEMPTS - 1:
+                raise
 
 
 class User(AbstractUser):
@@ -60,6 +78,10 @@ class User(AbstractUser):
         max_length=LENGTH_LIMITS_USER_FIELDS,
         blank=False
     )
+    updated_at = models.DateTimeField(
+        'Дата изменения',
+        auto_now=True
+    )
 
     def __str__(self):
         return self.username
@@ -145,6 +167,13 @@ class Recipe(models.Model):
     )
     image = models.ImageField(
         upload_to='recipes/images/',
+        storage=ContentAddressedStorage(),
+    )
+    image_variants = models.JSONField(
+        'Уменьшенные изображения',
+        default=dict,
+        blank=True,
+        editable=False
     )
     text = models.TextField(
         'Текст',
@@ -157,12 +186,45 @@ class Recipe(models.Model):
         'Дата публикации',
         auto_now_add=True
     )
+    updated_at = models.DateTimeField(
+        'Дата изменения',
+        auto_now=True
+    )
+    content_updated_at = models.DateTimeField(
+        'Дата изменения содержания',
+        auto_now=True,
+        db_index=True
+    )
+    favorites_count = models.PositiveIntegerField(
+        'В избранном',
+        default=0,
+        editable=False
+    )
+    in_carts_count = models.PositiveIntegerField(
+        'В списках покупок',
+        default=0,
+        editable=False
+    )
 
     class Meta:
         ordering = ('-pub_date',)
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         default_related_name = 'recipes'
+        indexes = [
+            models.Index(
+                fields=['-pub_date', 'id'],
+                name='recipe_pub_date_id_idx'
+            ),
+            models.Index(
+                fields=['-favorites_count'],
+                name='recipe_favorites_count_idx'
+            ),
+            models.Index(
+                fields=['-in_carts_count'],
+                name='recipe_in_carts_count_idx'
+            ),
+        ]
 
     def __str__(self):
         return RECIPE.format(
@@ -171,6 +233,39 @@ class Recipe(models.Model):
             pub_date=self.pub_date,
         )
 
+    @classmethod
+    def update_counter(cls, recipe_ids, field, delta):
+        """Атомарно меняет счетчик рецептов на delta без чтения строк.
+
+        Счетчики влияют на сортировку списков рецептов, поэтому после
+        фиксации транзакции увеличивается версия рецептов.
+        """
+        cls.objects.filter(pk__in=recipe_ids).update(**{
+            field: Greatest(F(field) + delta, 0),
+            'updated_at': timezone.now(),
+        })
+        transaction.on_commit(
+            lambda: ReferenceVersion.bump(ReferenceVersion.RECIPES))
+
+    @classmethod
+    def get_live_counters(cls):
+        """Рецепты со счетчиками, посчитанными по избранному и
+        спискам покупок."""
+        return cls.objects.annotate(
+            live_favorites_count=Coalesce(Subquery(
+                Favorite.objects.filter(
+                    recipe=OuterRef('pk')
+                ).order_by().values('recipe').annotate(
+                    count=Count('pk')).values('count')
+            ), 0),
+            live_in_carts_count=Coalesce(Subquery(
+                ShoppingList.objects.filter(
+                    recipe=OuterRef('pk')
+                ).order_by().values('recipe').annotate(
+                    count=Count('pk')).values('count')
+            ), 0),
+        )
+
 
 class RecipeIngredient(models.Model):
 
@@ -199,6 +294,10 @@ class RecipeIngredient(models.Model):
             fields=['ingredient', 'recipe'],
             name='unique_recipe_ingredient'
         )]
+        indexes = [models.Index(
+            fields=['recipe', 'ingredient'],
+            name='recipe_ingredient_idx'
+        )]
 
     def __str__(self):
         return f'{self.recipe} / {self.ingredient} / {self.amount}'
@@ -220,6 +319,11 @@ class UserRecipeAbstractModel(models.Model):
         related_name='%(class)ss',
         verbose_name='Рецепт'
     )
+    added_at = models.DateTimeField(
+        'Дата добавления',
+        default=timezone.now,
+        db_index=True
+    )
 
     class Meta:
         abstract = True
@@ -234,6 +338,7 @@ class UserRecipeAbstractModel(models.Model):
 
 class Favorite(UserRecipeAbstractModel):
     """Модель избранного."""
+    COUNTER_FIELD = 'favorites_count'
 
     class Meta(UserRecipeAbstractModel.Meta):
 
@@ -243,24 +348,247 @@ class Favorite(UserRecipeAbstractModel):
 
 class ShoppingList(UserRecipeAbstractModel):
     """Модель списка покупок."""
+    COUNTER_FIELD = 'in_carts_count'
+
     class Meta(UserRecipeAbstractModel.Meta):
         verbose_name = 'Список покупок'
         verbose_name_plural = 'Списки покупок'
 
     @staticmethod
     def get_shopping_list_ingredients(user):
-        return RecipeIngredient.objects.filter(
-            recipe__shoppinglists__user=user
-        ).values(
+        return ShoppingListIngredient.objects.filter(
+            user=user
+        ).order_by('ingredient__name').values(
+            'ingredient',
             'ingredient__name',
-            'ingredient__measurement_unit'
-        ).annotate(amount=Sum('amount'))
+            'ingredient__measurement_unit',
+            amount=F('total_amount'),
+        )
 
     @staticmethod
     def get_shopping_list_recipes(user):
-        return RecipeIngredient.objects.filter(
-            recipe__shoppinglists__user=user
-        ).distinct()
+        return Recipe.objects.filter(shoppinglists__user=user)
+
+
+class ShoppingListIngredient(models.Model):
+    """Суммарное количество продукта в списке покупок пользователя."""
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='shoppinglistingredients',
+        verbose_name='Пользователь'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='shoppinglistingredients',
+        verbose_name='Продукт'
+    )
+    total_amount = models.PositiveIntegerField('Мера')
+    recipe_count = models.PositiveIntegerField('Рецептов')
+
+    class Meta:
+        verbose_name = 'Продукт в списке покупок'
+        verbose_name_plural = 'Продукты в списках покупок'
+        constraints = [models.UniqueConstraint(
+            fields=['user', 'ingredient'],
+            name='unique_shopping_list_ingredient'
+        )]
+
+    def __str__(self):
+        return f'{self.user} / {self.ingredient} / {self.total_amount}'
+
+    @staticmethod
+    def get_live_amounts(user_ids=None):
+        """Агрегат списков покупок, посчитанный по рецептам."""
+        # Оба условия в одном filter(), чтобы не получить второй JOIN.
+        conditions = {'recipe__shoppinglists__isnull': False}
+        if user_ids is not None:
+            conditions['recipe__shoppinglists__user__in'] = user_ids
+        return RecipeIngredient.objects.filter(**conditions).values(
+            'ingredient',
+            user=F('recipe__shoppinglists__user'),
+        ).annotate(
+            total_amount=Sum('amount'),
+            recipe_count=Count('recipe'),
+        ).values_list(
+            'user', 'ingredient', 'total_amount', 'recipe_count'
+        ).order_by()
+
+    @staticmethod
+    def get_recipe_amounts(recipe):
+        return dict(RecipeIngredient.objects.filter(
+            recipe=recipe
+        ).values_list('ingredient_id', 'amount'))
+
+    @staticmethod
+    def get_recipes_amounts(recipe_ids):
+        """Суммы продуктов нескольких рецептов и число рецептов с каждым
+        продуктом: ({ingredient_id: amount}, {ingredient_id: count})."""
+        amounts, recipe_counts = {}, {}
+        for ingredient_id, amount, count in RecipeIngredient.objects.filter(
+            recipe_id__in=recipe_ids
+        ).values('ingredient_id').annotate(
+            total_amount=Sum('amount'), recipe_count=Count('recipe')
+        ).values_list(
+            'ingredient_id', 'total_amount', 'recipe_count'
+        ).order_by():
+            amounts[ingredient_id] = amount
+            recipe_counts[ingredient_id] = count
+        return amounts, recipe_counts
+
+    @classmethod
+    def update_amounts(cls, user_ids, amounts, sign=1, recipe_counts=None):
+        """Прибавляет (sign=1) или вычитает (sign=-1) продукты рецепта
+        {ingredient_id: amount} из списков покупок пользователей.
+        recipe_counts задает изменение числа рецептов на продукт: если
+        amounts — сумма нескольких рецептов или разница при изменении
+        рецепта."""
+        user_ids = list(user_ids)
+        if user_ids and amounts:
+            retry_on_conflict(
+                cls.write_amounts, user_ids, amounts, sign, recipe_counts)
+
+    @classmethod
+    def write_amounts(cls, user_ids, amounts, sign, recipe_counts):
+        rows = {
+            (row.user_id, row.ingredient_id): row
+            for row in cls.objects.select_for_update().filter(
+                user_id__in=user_ids,
+                ingredient_id__in=amounts,
+            )
+        }
+        new_rows = []
+        for user_id in user_ids:
+            for ingredient_id, amount in amounts.items():
+                count = recipe_counts[ingredient_id] if recipe_counts else 1
+                row = rows.get((user_id, ingredient_id))
+                if row is not None:
+                    row.total_amount += sign * amount
+                    row.recipe_count += sign * count
+                elif sign * count > 0:
+                    new_rows.append(cls(
+                        user_id=user_id,
+                        ingredient_id=ingredient_id,
+                        total_amount=amount,
+                        recipe_count=count,
+                    ))
+        empty_rows = [
+            row.pk for row in rows.values() if row.recipe_count <= 0]
+        cls.objects.filter(pk__in=empty_rows).delete()
+        cls.objects.bulk_update(
+            [row for row in rows.values() if row.recipe_count > 0],
+            ('total_amount', 'recipe_count')
+        )
+        cls.objects.bulk_create(new_rows)
+
+    @classmethod
+    def refresh(cls, user_ids):
+        """Пересчитывает списки покупок пользователей по рецептам."""
+        user_ids = sorted(user_ids)
+        if user_ids:
+            retry_on_conflict(cls.write_live_amounts, user_ids)
+
+    @classmethod
+    def write_live_amounts(cls, user_ids):
+        cls.objects.filter(user_id__in=user_ids).delete()
+        cls.objects.bulk_create(
+            (
+                cls(
+                    user_id=user_id,
+                    ingredient_id=ingredient_id,
+                    total_amount=total_amount,
+                    recipe_count=recipe_count,
+                )
+                for user_id, ingredient_id, total_amount, recipe_count
+                in cls.get_live_amounts(user_ids)
+            )
+        )
+
+
+class RecipeSearchEntry(models.Model):
+    """Запись рецепта в полнотекстовом индексе SQLite FTS5.
+
+    Таблицу создает миграция 0022, rowid записи равен id рецепта.
+    Модель нужна, чтобы Django сам присоединял индекс к рецептам с
+    правильными псевдонимами таблиц, в том числе в подзапросах.
+    """
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.DO_NOTHING,
+        primary_key=True,
+        db_column='rowid',
+        db_constraint=False,
+        related_name='search_entry',
+        verbose_name='Рецепт'
+    )
+    # Скрытый столбец FTS5 с именем таблицы: левая часть MATCH и
+    # первый аргумент bm25.
+    document = models.TextField(
+        'Документ', db_column='recipes_recipe_fts', editable=False)
+
+    class Meta:
+        managed = False
+        db_table = 'recipes_recipe_fts'
+        verbose_name = 'Запись поискового индекса'
+        verbose_name_plural = 'Записи поискового индекса'
+
+
+class SimilarRecipe(models.Model):
+    """Похожий рецепт, заранее найденный по общим продуктам и тегам."""
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='similar_recipes',
+        verbose_name='Рецепт'
+    )
+    similar = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='similar_to',
+        verbose_name='Похожий рецепт'
+    )
+    score = models.FloatField('Сходство')
+    computed_at = models.DateTimeField('Дата расчета')
+
+    class Meta:
+        verbose_name = 'Похожий рецепт'
+        verbose_name_plural = 'Похожие рецепты'
+        constraints = [models.UniqueConstraint(
+            fields=['recipe', 'similar'],
+            name='unique_similar_recipe'
+        )]
+        indexes = [models.Index(
+            fields=['recipe', '-score'],
+            name='similar_recipe_score_idx'
+        )]
+
+    def __str__(self):
+        return f'{self.recipe_id} / {self.similar_id} / {self.score:.3f}'
+
+
+class TrendingScore(models.Model):
+    """Популярность рецепта с экспоненциальным затуханием по времени."""
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='trending_score',
+        verbose_name='Рецепт'
+    )
+    score = models.FloatField('Рейтинг', default=0)
+    refreshed_at = models.DateTimeField('Дата пересчета')
+
+    class Meta:
+        verbose_name = 'Рейтинг популярности'
+        verbose_name_plural = 'Рейтинги популярности'
+        indexes = [models.Index(
+            fields=['-score'],
+            name='trending_score_idx'
+        )]
+
+    def __str__(self):
+        return f'{self.recipe_id} / {self.score:.3f}'
 
 
 class Subscription(models.Model):
@@ -293,3 +621,196 @@ class Subscription(models.Model):
 
     def __str__(self):
         return f'{self.user} / {self.author}'
+
+
+class FeedItem(models.Model):
+    """Рецепт в ленте подписок пользователя (fan-out on write)."""
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feeditems',
+        verbose_name='Подписчик'
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='feeditems',
+        verbose_name='Рецепт'
+    )
+    pub_date = models.DateTimeField('Дата публикации')
+
+    class Meta:
+        verbose_name = 'Рецепт в ленте'
+        verbose_name_plural = 'Ленты подписок'
+        constraints = [models.UniqueConstraint(
+            fields=['user', 'recipe'],
+            name='unique_feed_item'
+        )]
+        indexes = [models.Index(
+            fields=['user', '-pub_date', 'recipe'],
+            name='feed_item_user_pub_date_idx'
+        )]
+
+    def __str__(self):
+        return f'{self.user} / {self.recipe}'
+
+    @staticmethod
+    def is_pull_author(author_id):
+        """Рецепты авторов с большим числом подписчиков не раскладываются
+        по лентам, а читаются при запросе ленты."""
+        return Subscription.objects.filter(
+            author_id=author_id
+        ).count() > settings.FEED_FANOUT_MAX_SUBSCRIBERS
+
+    @staticmethod
+    def get_pull_authors(user):
+        return Subscription.objects.filter(user=user).annotate(
+            subscribers_count=Subquery(
+                Subscription.objects.filter(
+                    author=OuterRef('author')
+                ).order_by().values('author').annotate(
+                    count=Count('pk')).values('count')
+            )
+        ).filter(
+            subscribers_count__gt=settings.FEED_FANOUT_MAX_SUBSCRIBERS
+        ).values('author')
+
+    @classmethod
+    def get_feed(cls, user, recipes=None):
+        """Пары (recipe_id, pub_date) ленты по убыванию даты: разложенные
+        при публикации и рецепты популярных авторов, которые берутся
+        напрямую. Порядок и LIMIT берутся из индекса ленты, без чтения
+        рецептов. recipes — отфильтрованные рецепты, если лента
+        фильтруется."""
+        items = cls.objects.filter(user=user)
+        pull_authors = list(cls.get_pull_authors(user).values_list(
+            'author', flat=True))
+        pulled = Recipe.objects.filter(author__in=pull_authors)
+        if recipes is not None:
+            items = items.filter(recipe__in=recipes.values('pk'))
+            pulled = pulled.filter(pk__in=recipes.values('pk'))
+        items = items.values_list('recipe_id', 'pub_date')
+        if pull_authors:
+            # Рецепт, разложенный до того, как автор стал популярным,
+            # есть в обеих частях; UNION оставляет одну строку.
+            items = items.union(
+                pulled.values_list('id', 'pub_date').order_by())
+        return items.order_by('-pub_date', 'recipe_id')
+
+    @classmethod
+    def fan_out(cls, recipe):
+        """Раскладывает новый рецепт по лентам подписчиков автора."""
+        if cls.is_pull_author(recipe.author_id):
+            return
+        cls.objects.bulk_create(
+            (
+                cls(user_id=user_id, recipe=recipe, pub_date=recipe.pub_date)
+                for user_id in Subscription.objects.filter(
+                    author_id=recipe.author_id
+                ).values_list('user_id', flat=True).iterator()
+            ),
+            batch_size=FEED_BATCH_SIZE,
+            ignore_conflicts=True
+        )
+
+    @classmethod
+    def backfill(cls, user, author):
+        """Добавляет в ленту последние рецепты нового автора."""
+        if cls.is_pull_author(author.id):
+            return
+        cls.objects.bulk_create(
+            (
+                cls(user=user, recipe_id=recipe_id, pub_date=pub_date)
+                for recipe_id, pub_date in Recipe.objects.filter(
+                    author=author
+                ).order_by('-pub_date').values_list(
+                    'id', 'pub_date'
+                )[:settings.FEED_BACKFILL_SIZE]
+            ),
+            batch_size=FEED_BATCH_SIZE,
+            ignore_conflicts=True
+        )
+
+    @classmethod
+    def backfill_subscribers(cls, author_id):
+        """Раскладывает последние рецепты автора по лентам подписчиков,
+        когда подписчиков стало не больше порога и рецепты автора
+        перестали читаться напрямую."""
+        subscribers = Subscription.objects.filter(author_id=author_id)
+        subscribers_count = subscribers.count()
+        if (
+            not subscribers_count
+            or subscribers_count > settings.FEED_FANOUT_MAX_SUBSCRIBERS
+        ):
+            return
+        recipes = list(Recipe.objects.filter(
+            author_id=author_id
+        ).order_by('-pub_date').values_list(
+            'id', 'pub_date'
+        )[:settings.FEED_BACKFILL_SIZE])
+        if not recipes or cls.objects.filter(
+            recipe_id=recipes[0][0], user__in=subscribers.values('user')
+        ).count() == subscribers_count:
+            return
+        cls.objects.bulk_create(
+            (
+                cls(user_id=user_id, recipe_id=recipe_id, pub_date=pub_date)
+                for user_id in subscribers.values_list(
+                    'user_id', flat=True).iterator()
+                for recipe_id, pub_date in recipes
+            ),
+            batch_size=FEED_BATCH_SIZE,
+            ignore_conflicts=True
+        )
+
+    @classmethod
+    def prune(cls, user, author):
+        cls.objects.filter(user=user, recipe__author=author).delete()
+
+
+class ReferenceVersion(models.Model):
+    """Версии справочников для сброса кэша во всех процессах."""
+    TAGS = 'tags'
+    INGREDIENTS = 'ingredients'
+    RECIPE_INGREDIENTS = 'recipe_ingredients'
+    RECIPES = 'recipes'
+
+    name = models.CharField(
+        'Справочник',
+        max_length=LENGTH_LIMITS_NAME_AND_SLUG_FIELDS,
+        unique=True
+    )
+    version = models.PositiveIntegerField('Версия', default=0)
+    updated_at = models.DateTimeField('Дата изменения', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Версия справочника'
+        verbose_name_plural = 'Версии справочников'
+
+    def __str__(self):
+        return f'{self.name} / {self.version}'
+
+    @classmethod
+    def get_version(cls, name):
+        return cls.objects.filter(name=name).values_list(
+            'version', flat=True).first() or 0
+
+    @classmethod
+    def get_states(cls, *names):
+        """Пары (версия, дата изменения) справочников одним запросом."""
+        states = dict.fromkeys(names, (0, None))
+        states.update(
+            (name, (version, updated_at))
+            for name, version, updated_at in cls.objects.filter(
+                name__in=names
+            ).values_list('name', 'version', 'updated_at')
+        )
+        return states
+
+    @classmethod
+    def bump(cls, name):
+        if not cls.objects.filter(name=name).update(
+            version=F('version') + 1,
+            updated_at=timezone.now()
+        ):
+            cls.objects.get_or_create(name=name, defaults={'version': 1})
@@ -0,0 +1,191 @@
+from itertools import chain
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+
+from .models import Recipe, RecipeIngredient, SimilarRecipe
+
+
+SIMILAR_RECIPES_LIMIT = 10
+TAG_FEATURE_WEIGHT = 0.5
+CHUNK_SIZE = 10000
+BATCH_SIZE = 1000
+
+
+def load_pairs(queryset, fields):
+    return np.fromiter(
+        chain.from_iterable(
+            queryset.values_list(*fields).iterator(chunk_size=CHUNK_SIZE)),
+        dtype=np.int64
+    ).reshape(-1, 2)
+
+
+def get_offsets(indices, size):
+    return np.concatenate(
+        ([0], np.cumsum(np.bincount(indices, minlength=size))))
+
+
+class RecipeFeatureMatrix:
+    """Разреженная матрица «рецепт × признак» в памяти.
+
+    Признаки — продукты рецепта (вес 1) и его теги (вес TAG_FEATURE_WEIGHT).
+    Продукты хранятся двумя отсортированными представлениями: по строкам
+    (продукты рецепта) и по столбцам (рецепты с продуктом). Кандидаты
+    в похожие ищутся только по общим продуктам: теги есть почти у каждого
+    рецепта, и поиск по ним сравнивал бы все рецепты со всеми. Тегов мало,
+    они хранятся плотной матрицей и только уточняют оценку кандидатов.
+    Сходство — косинус между строками; для бинарных признаков он совпадает
+    с коэффициентом Отиаи, близким к коэффициенту Жаккара.
+    """
+
+    def __init__(self, ingredients, tags):
+        self.recipe_ids, rows = np.unique(
+            np.concatenate((ingredients[:, 0], tags[:, 0])),
+            return_inverse=True
+        )
+        rows, tag_rows = rows[:len(ingredients)], rows[len(ingredients):]
+        _, columns = np.unique(ingredients[:, 1], return_inverse=True)
+        order = np.lexsort((columns, rows))
+        self.row_offsets = get_offsets(rows, len(self.recipe_ids))
+        self.row_columns = columns[order]
+        order = np.lexsort((rows, columns))
+        self.column_offsets = get_offsets(
+            columns, columns.max() + 1 if len(columns) else 0)
+        self.column_rows = rows[order]
+        _, tag_columns = np.unique(tags[:, 1], return_inverse=True)
+        self.tags = np.zeros(
+            (
+                len(self.recipe_ids),
+                tag_columns.max() + 1 if len(tag_columns) else 0
+            ),
+            dtype=bool
+        )
+        self.tags[tag_rows, tag_columns] = True
+        self.norms = np.sqrt(
+            np.bincount(rows, minlength=len(self.recipe_ids))
+            + self.tags.sum(axis=1) * TAG_FEATURE_WEIGHT ** 2
+        )
+
+    @classmethod
+    def load(cls):
+        return cls(
+            load_pairs(
+                RecipeIngredient.objects.all(),
+                ('recipe_id', 'ingredient_id')
+            ),
+            load_pairs(
+                Recipe.tags.through.objects.all(), ('recipe_id', 'tag_id'))
+        )
+
+    def get_scores(self, recipe_id):
+        """Рецепты с общими продуктами и сходство с ними."""
+        row = np.searchsorted(self.recipe_ids, recipe_id)
+        if (
+            row == len(self.recipe_ids)
+            or self.recipe_ids[row] != recipe_id
+        ):
+            return np.empty(0, np.int64), np.empty(0)
+        start, end = self.row_offsets[row], self.row_offsets[row + 1]
+        columns = self.row_columns[start:end]
+        starts = self.column_offsets[columns]
+        lengths = self.column_offsets[columns + 1] - starts
+        # Индексы всех рецептов из столбцов columns одним массивом.
+        positions = np.arange(lengths.sum()) + np.repeat(
+            starts - np.cumsum(lengths) + lengths, lengths)
+        rows, shared = np.unique(
+            self.column_rows[positions], return_counts=True)
+        dots = shared + np.count_nonzero(
+            self.tags[rows] & self.tags[row], axis=1
+        ) * TAG_FEATURE_WEIGHT ** 2
+        scores = dots / (self.norms[row] * self.norms[rows])
+        other = rows != row
+        return self.recipe_ids[rows[other]], scores[other]
+
+    def get_neighbours(self, recipe_id, limit=SIMILAR_RECIPES_LIMIT):
+        """limit самых похожих рецептов; при равном сходстве — с меньшим
+        id, чтобы частичный и полный расчеты выбирали одинаково."""
+        recipe_ids, scores = self.get_scores(recipe_id)
+        if len(scores) > limit:
+            threshold = np.partition(scores, -limit)[-limit]
+            top = scores >= threshold
+            recipe_ids, scores = recipe_ids[top], scores[top]
+        order = np.lexsort((recipe_ids, -scores))[:limit]
+        return recipe_ids[order], scores[order]
+
+
+def get_affected_recipes(matrix, changed_ids):
+    """Рецепты, списки похожих которых могут измениться из-за changed_ids:
+    сами измененные, те, у кого они были в списке, и те, в чей список они
+    теперь попадают.
+
+    Удаленный рецепт каскадно пропадает из чужих списков, и они
+    становятся короче SIMILAR_RECIPES_LIMIT: неполные и пустые списки
+    пересчитываются всегда, так что удаления не нужно запоминать.
+    """
+    affected = set(changed_ids)
+    affected.update(SimilarRecipe.objects.filter(
+        similar_id__in=changed_ids
+    ).values_list('recipe_id', flat=True))
+    bounds = {
+        recipe_id: (count, min_score)
+        for recipe_id, count, min_score in SimilarRecipe.objects.values(
+            'recipe'
+        ).annotate(
+            count=Count('pk'), min_score=Min('score')
+        ).values_list('recipe', 'count', 'min_score').order_by()
+    }
+    affected.update(
+        recipe_id for recipe_id in matrix.recipe_ids.tolist()
+        if bounds.get(recipe_id, (0, 0))[0] < SIMILAR_RECIPES_LIMIT
+    )
+    for recipe_id in changed_ids:
+        for other_id, score in zip(*matrix.get_scores(recipe_id)):
+            count, min_score = bounds.get(other_id, (0, 0))
+            if count < SIMILAR_RECIPES_LIMIT or score > min_score:
+                affected.add(int(other_id))
+    return affected
+
+
+@transaction.atomic
+def build_similar_recipes(full=False):
+    """Пересчитывает таблицу похожих рецептов.
+
+    Без full пересчитываются только рецепты, измененные после прошлого
+    расчета, и рецепты, на чьи списки они влияют. Возвращает число
+    пересчитанных рецептов.
+    """
+    now = timezone.now()
+    since = None
+    if not full:
+        since = SimilarRecipe.objects.aggregate(
+            since=Max('computed_at'))['since']
+    matrix = RecipeFeatureMatrix.load()
+    if since is None:
+        SimilarRecipe.objects.all().delete()
+        affected = matrix.recipe_ids.tolist()
+    else:
+        affected = get_affected_recipes(matrix, list(
+            Recipe.objects.filter(
+                content_updated_at__gt=since
+            ).values_list('pk', flat=True)
+        ))
+        SimilarRecipe.objects.filter(recipe_id__in=affected).delete()
+    SimilarRecipe.objects.bulk_create(
+        (
+            SimilarRecipe(
+                recipe_id=recipe_id,
+                similar_id=similar_id,
+                score=score,
+                computed_at=now,
+            )
+            for recipe_id in affected
+            for similar_id, score in zip(
+                *(array.tolist() for array in matrix.get_neighbours(
+                    recipe_id))
+            )
+        ),
+        batch_size=BATCH_SIZE
+    )
+    return len(affected)
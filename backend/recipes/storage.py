@@ -0,0 +1,35 @@
+import hashlib
+import os
+import posixpath
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Файловое хранилище, где имя файла — SHA-256 его содержимого.
+
+    Одинаковые файлы хранятся один раз: если файл с таким содержимым уже
+    есть, он не перезаписывается, а только получает новое время изменения,
+    чтобы clean_media не удалил его как старый неиспользуемый. Файлы не
+    удаляются при изменении рецептов, неиспользуемые удаляет команда
+    clean_media.
+    """
+
+    def get_content_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        digest = digest.hexdigest()
+        directory, filename = posixpath.split(name)
+        extension = posixpath.splitext(filename)[1].lower()
+        return posixpath.join(directory, digest[:2], f'{digest}{extension}')
+
+    def _save(self, name, content):
+        name = self.get_content_name(name, content)
+        if self.exists(name):
+            os.utime(self.path(name))
+            return name
+        return super()._save(name, content)
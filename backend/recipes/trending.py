@@ -0,0 +1,81 @@
+import math
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max
+from django.utils import timezone
+
+from .models import Favorite, ShoppingList, TrendingScore
+
+
+TRENDING_WEIGHTS = (
+    (Favorite, 1.0),
+    (ShoppingList, 2.0),
+)
+MIN_SCORE = 0.01
+HORIZON_HALF_LIVES = 8
+BATCH_SIZE = 1000
+
+
+def get_decay_rate():
+    return math.log(2) / timedelta(
+        hours=settings.TRENDING_HALF_LIFE_HOURS).total_seconds()
+
+
+def get_new_scores(since, now, rate):
+    """Вклад событий (since, now] в рейтинг рецептов на момент now."""
+    scores = defaultdict(float)
+    for model, weight in TRENDING_WEIGHTS:
+        events = model.objects.filter(added_at__lte=now)
+        if since is not None:
+            events = events.filter(added_at__gt=since)
+        for recipe_id, added_at in events.values_list(
+            'recipe_id', 'added_at'
+        ).iterator():
+            scores[recipe_id] += weight * math.exp(
+                -rate * (now - added_at).total_seconds())
+    return scores
+
+
+@transaction.atomic
+def refresh_trending_scores(full=False):
+    """Пересчитывает рейтинги популярности.
+
+    Без full старые рейтинги уменьшаются на общий множитель затухания
+    и к ним прибавляются только события после прошлого пересчета.
+    С full таблица строится заново по событиям за HORIZON_HALF_LIVES
+    периодов полураспада.
+    """
+    now = timezone.now()
+    rate = get_decay_rate()
+    since = None
+    if not full:
+        since = TrendingScore.objects.aggregate(
+            since=Max('refreshed_at'))['since']
+    if since is None:
+        TrendingScore.objects.all().delete()
+        since = now - timedelta(
+            hours=settings.TRENDING_HALF_LIFE_HOURS * HORIZON_HALF_LIVES)
+    else:
+        TrendingScore.objects.update(
+            score=F('score') * math.exp(
+                -rate * (now - since).total_seconds()),
+            refreshed_at=now
+        )
+    scores = get_new_scores(since, now, rate)
+    rows = TrendingScore.objects.select_for_update().in_bulk(list(scores))
+    for recipe_id, row in rows.items():
+        row.score += scores.pop(recipe_id)
+    TrendingScore.objects.bulk_update(
+        rows.values(), ('score',), batch_size=BATCH_SIZE)
+    TrendingScore.objects.bulk_create(
+        (
+            TrendingScore(recipe_id=recipe_id, score=score, refreshed_at=now)
+            for recipe_id, score in scores.items()
+        ),
+        batch_size=BATCH_SIZE
+    )
+    TrendingScore.objects.filter(score__lt=MIN_SCORE).delete()
+    return TrendingScore.objects.count()